@@ -1,19 +1,32 @@
-from flask import Flask, render_template, request
-from vrptw import run_vrptw
+import asyncio
+import logging
+import os
+import time
+from flask import Flask, abort, jsonify, make_response, render_template, request, url_for
+from artifacts import MAP_ARTIFACT_TTL, map_store
+from jobs import JobQueue, QueueFull
+from maps import MATRIX_PROVIDERS
+from tracing import metrics
+from vrptw import SEARCH_PROFILES, run_vrptw_async, solve_instruction
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 app = Flask(__name__)
+# solves run in worker processes, so their traces are folded into this process's metrics
+solve_jobs = JobQueue(solve_instruction, on_result=lambda result: metrics.merge(result.get("trace")))
+# upper bound on how long POST /solve may block when the client asks to wait for the result
+MAX_WAIT_SECONDS = 30
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     instruction = ""
     summary = explanation = stats = None
-    map_path = None
+    map_url = None
 
     if request.method == "POST":
         instruction = request.form.get("instruction", "")
 
         # Call your route logic
-        map_file, summary_text, trip_summary, explanation, *_ = run_vrptw(instruction)
+        map_id, summary_text, trip_summary, explanation, *_ = asyncio.run(run_vrptw_async(instruction))
 
         if summary_text:
             summary = summary_text.replace("\n", "<br>")
@@ -28,7 +41,7 @@ def index():
                 "end_time": trip_summary.get("end_time")
             }
 
-        map_path = "route_map.html" if map_file else None
+        map_url = url_for("route_map", map_id=map_id) if map_id else None
 
     return render_template(
         "index.html",
@@ -36,8 +49,79 @@ def index():
         summary=summary,
         stats=stats,
         explanation=explanation,
-        map_path=map_path
+        map_url=map_url
     )
 
+
+@app.route("/maps/<map_id>", methods=["GET"])
+def route_map(map_id):
+    """Serves a rendered map from memory. Map ids are content addresses, so responses never change."""
+    html = map_store.get(map_id)
+    if html is None:
+        abort(404)
+    if request.if_none_match.contains(map_id):
+        return "", 304
+    response = make_response(html)
+    response.headers["Content-Type"] = "text/html; charset=utf-8"
+    response.headers["Cache-Control"] = f"private, max-age={MAP_ARTIFACT_TTL}, immutable"
+    response.set_etag(map_id)
+    return response
+
+@app.route("/solve", methods=["POST"])
+def solve():
+    """
+    Queues a solve and returns 202 with the job id; poll GET /jobs/<id> for the result.
+    Body: {"instruction": str, "search_profile"?: str, "matrix_provider"?: str, "wait"?: seconds}
+    """
+    body = request.get_json(silent=True) or {}
+    instruction = body.get("instruction")
+    if not isinstance(instruction, str) or not instruction.strip():
+        return jsonify({"error": "'instruction' must be a non-empty string"}), 400
+
+    search_profile = body.get("search_profile")
+    if search_profile is not None and search_profile not in SEARCH_PROFILES:
+        return jsonify({"error": f"Unknown search_profile {search_profile!r}"}), 400
+    matrix_provider = body.get("matrix_provider")
+    if matrix_provider is not None and matrix_provider not in MATRIX_PROVIDERS:
+        return jsonify({"error": f"Unknown matrix_provider {matrix_provider!r}"}), 400
+
+    try:
+        job = solve_jobs.submit(
+            instruction=instruction.strip(),
+            search_profile=search_profile,
+            matrix_provider=matrix_provider
+        )
+    except QueueFull as e:
+        return jsonify({"error": f"Solver queue is full ({e}), try again later"}), 503
+
+    try:
+        wait = min(float(body.get("wait", 0)), MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        wait = 0
+    deadline = time.time() + wait
+    while job.state in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.1)
+
+    payload = job.to_dict()
+    payload["status_url"] = url_for("job_status", job_id=job.id)
+    return jsonify(payload), 200 if payload["status"] == "done" else 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = solve_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    payload = job.to_dict()
+    payload["status_url"] = url_for("job_status", job_id=job.id)
+    return jsonify(payload)
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Stage latencies, API call counts and cache hits in the Prometheus text format."""
+    response = make_response(metrics.prometheus_text())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
 if __name__ == "__main__":
     app.run(debug=True)
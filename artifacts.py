@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+MAP_ARTIFACT_TTL = int(os.getenv("MAP_ARTIFACT_TTL", 3600))
+MAP_ARTIFACT_MAX_ENTRIES = int(os.getenv("MAP_ARTIFACT_MAX_ENTRIES", 256))
+
+
+def artifact_key(*parts):
+    """Content address of a rendered artifact: a sha256 over its JSON-serialisable inputs."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def array_digest(values):
+    """sha256 of a numeric array's contents, so large matrices can be part of an artifact_key cheaply."""
+    array = np.ascontiguousarray(values, dtype=float)
+    return hashlib.sha256(str(array.shape).encode("utf-8") + array.tobytes()).hexdigest()
+
+
+class ArtifactStore:
+    """
+    In-memory store for rendered HTML, keyed by content address.
+    Each request gets its own entry, so concurrent users never overwrite each other's maps,
+    and identical routes map to the same key and are rendered once.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted past `max_entries`.
+    """
+
+    def __init__(self, ttl=MAP_ARTIFACT_TTL, max_entries=MAP_ARTIFACT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._expire()
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, content):
+        with self._lock:
+            self._items[key] = (time.time(), content)
+            self._items.move_to_end(key)
+            self._expire()
+        return key
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _expire(self):
+        if self.ttl is not None:
+            cutoff = time.time() - self.ttl
+            for key in [key for key, (created_at, _) in self._items.items() if created_at < cutoff]:
+                del self._items[key]
+        while self.max_entries is not None and len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+
+map_store = ArtifactStore()
@@ -0,0 +1,149 @@
+"""
+Solve many instructions in parallel and stream the results to a JSONL file.
+
+    python batch.py user_instruction_scenarios.txt --output results.jsonl
+    python batch.py days.jsonl --workers 8 --profile fast --resume
+
+Input is either a scenario file (=== Scenario: name === blocks) or JSONL with one
+{"id", "instruction", "search_profile"?, "matrix_provider"?} object (or a bare JSON string) per line.
+Each output line is {"id", "status", "seconds", "result" | "error"}, written as soon as that job finishes.
+Workers share the SQLite parse, geocode and travel caches, so repeated addresses are fetched once.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tracing import Metrics
+from vrptw import load_user_instructions, solve_instruction
+
+DEFAULT_WORKERS = int(os.getenv("BATCH_WORKERS", os.cpu_count() or 2))
+
+
+def load_jobs(path):
+    """[{"id", "instruction", ...}] from a scenario file or a JSONL file."""
+    if not path.endswith(".jsonl"):
+        return [{"id": name, "instruction": text} for name, text in load_user_instructions(path).items()]
+
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if isinstance(job, str):
+                job = {"instruction": job}
+            job.setdefault("id", str(line_number))
+            jobs.append(job)
+    return jobs
+
+
+def finished_ids(path):
+    """Ids already written to an output file, so an interrupted batch can resume."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {json.loads(line)["id"] for line in f if line.strip()}
+
+
+def run_job(job, search_profile=None, matrix_provider=None):
+    """Worker entry point: solves one job and never raises, so one bad instruction cannot stop the batch."""
+    start = time.perf_counter()
+    record = {"id": job["id"]}
+    try:
+        result = solve_instruction(
+            job["instruction"],
+            search_profile=job.get("search_profile", search_profile),
+            matrix_provider=job.get("matrix_provider", matrix_provider)
+        )
+        record["status"] = result["status"]
+        record["result"] = result
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["traceback"] = traceback.format_exc()
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(jobs, output_path, workers=DEFAULT_WORKERS, search_profile=None, matrix_provider=None, resume=False):
+    """Fans jobs out over a process pool, appending each result to `output_path` as it completes."""
+    done = finished_ids(output_path) if resume else set()
+    pending = [job for job in jobs if job["id"] not in done]
+    if done:
+        print(f"Skipping {len(jobs) - len(pending)} jobs already in {output_path}")
+
+    metrics = Metrics()
+    records = []
+    start = time.perf_counter()
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job, search_profile, matrix_provider) for job in pending]
+        for count, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            records.append(record)
+            metrics.merge(record.get("result", {}).get("trace"))
+            print(f"[{count}/{len(pending)}] {record['id']}: {record['status']} in {record['seconds']:.1f}s")
+    wall = time.perf_counter() - start
+    return summarize_batch(records, wall, metrics)
+
+
+def summarize_batch(records, wall_seconds, metrics):
+    seconds = sorted(record["seconds"] for record in records)
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+    return {
+        "jobs": len(records),
+        "statuses": statuses,
+        "wall_seconds": round(wall_seconds, 2),
+        "jobs_per_minute": round(len(records) / wall_seconds * 60, 1) if wall_seconds else None,
+        "median_seconds": statistics.median(seconds) if seconds else None,
+        "p95_seconds": seconds[int(0.95 * (len(seconds) - 1))] if seconds else None,
+        "failures": [
+            {"id": record["id"], "status": record["status"], "error": record.get("error") or record["result"].get("error")}
+            for record in records if record["status"] != "ok"
+        ],
+        "events": dict(sorted(metrics.counters.items())),
+    }
+
+
+def print_summary(summary):
+    print("\n=== Batch Summary ===")
+    print(f"Jobs: {summary['jobs']} ({', '.join(f'{n} {status}' for status, n in summary['statuses'].items())})")
+    print(f"Wall time: {summary['wall_seconds']}s, {summary['jobs_per_minute']} jobs/min")
+    print(f"Per job: median {summary['median_seconds']}s, p95 {summary['p95_seconds']}s")
+    for name, value in summary["events"].items():
+        print(f"{name}: {value}")
+    if summary["failures"]:
+        print("\n❌ Failures:")
+        for failure in summary["failures"]:
+            print(f"{failure['id']} ({failure['status']}): {(failure['error'] or '').splitlines()[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="scenario file or .jsonl of instructions")
+    parser.add_argument("--output", default="batch_results.jsonl")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--profile", default=None, help="search profile, defaults to SEARCH_PROFILE")
+    parser.add_argument("--matrix-provider", default=None, help="google, sparse, estimate or osrm")
+    parser.add_argument("--resume", action="store_true", help="skip ids already in --output and append")
+    parser.add_argument("--summary", default=None, help="also write the summary as JSON to this path")
+    args = parser.parse_args()
+
+    summary = run_batch(
+        load_jobs(args.input), args.output, args.workers, args.profile, args.matrix_provider, args.resume
+    )
+    print_summary(summary)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+Solver benchmarks that run without OpenAI or Google Maps.
+
+    python benchmark.py transit --nodes 25 50 100 200
+    python benchmark.py suite --sizes 5 25 100 500 --output bench_report.json
+    python benchmark.py compare old_report.json bench_report.json
+    python benchmark.py decompose --sizes 100 200 --workers 4
+    python benchmark.py check --sizes 5 25 100 500
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import ortools
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+from decompose import DECOMPOSE_WORKERS, routes_are_feasible, solve_decomposed
+from maps import EstimateMatrixProvider
+from vrptw import build_transit_matrix, solve_vrptw
+
+# synthetic instances: stops scattered around Philadelphia, driven at an average city speed.
+# The area and stop durations shrink as stops are added so a single day stays plausible.
+CENTER = (39.95, -75.16)
+SPREAD_DEGREES = 0.3
+SERVICE_BUDGET_MINUTES = 300
+REFERENCE_DEPARTURE = 540
+# the reference tour, return leg included, must be home by the end of the day
+DAY_END = 1439
+ROAD_FACTOR = 1.3
+AVERAGE_SPEED_KMH = 40
+# half-width of each stop's arrival window, in minutes
+WINDOW_TIGHTNESS = {"wide": None, "medium": 120, "tight": 30}
+VARIANTS = ["round_trip", "custom_end", "precedence", "custom_end_precedence"]
+
+
+def synthetic_instance(num_stops, tightness="medium", variant="round_trip", seed=0):
+    """
+    Data dict in the shape parse_instruction + build_matrices produce, with Haversine-derived matrices.
+    `num_stops` excludes the depot; `variant` adds custom_end_index and/or precedence_constraints.
+    """
+    rng = np.random.default_rng(seed)
+    n = num_stops + 1
+    spread = SPREAD_DEGREES * min(1.0, np.sqrt(5 / num_stops))
+    coords = np.asarray(CENTER) + rng.uniform(-spread, spread, size=(n, 2))
+    time_matrix, distance_matrix = EstimateMatrixProvider(ROAD_FACTOR, AVERAGE_SPEED_KMH).get_matrices(None, coords)
+    time_matrix = np.asarray(time_matrix)
+    max_duration = int(np.clip(2 * SERVICE_BUDGET_MINUTES / num_stops, 3, 45))
+    durations = [0] + rng.integers(2, max_duration + 1, size=num_stops).tolist()
+
+    # windows are centred on the arrival times of a nearest-neighbour reference tour,
+    # so every instance has at least one feasible route and tightness sets the difficulty
+    reference = [0]
+    unvisited = set(range(1, n))
+    while unvisited:
+        nearest = min(unvisited, key=lambda j: (time_matrix[reference[-1], j], j))
+        reference.append(nearest)
+        unvisited.remove(nearest)
+
+    # with many stops the minimum stays alone overrun the day, so shorten them until the tour fits
+    travel = int(sum(time_matrix[a, b] for a, b in zip(reference, reference[1:] + [0])))
+    available = DAY_END - REFERENCE_DEPARTURE - travel
+    if available < 0:
+        raise ValueError(f"The reference tour of {num_stops} stops needs {travel} minutes of driving alone")
+    if sum(durations) > available:
+        scale = available / sum(durations)
+        durations = [int(duration * scale) for duration in durations]
+
+    arrivals = {}
+    clock = REFERENCE_DEPARTURE
+    for previous, node in zip(reference, reference[1:]):
+        clock += int(time_matrix[previous, node])
+        arrivals[node] = clock
+        clock += durations[node]
+    assert clock + time_matrix[reference[-1], 0] <= DAY_END, "reference tour overruns the day"
+
+    half_width = WINDOW_TIGHTNESS[tightness]
+    time_windows = [[0, 1439]]
+    for i in range(1, n):
+        if half_width is None:
+            time_windows.append([0, 1439])
+        else:
+            time_windows.append([max(0, arrivals[i] - half_width), min(1439, arrivals[i] + half_width)])
+
+    data = {
+        # the tour the windows were built around: a feasibility certificate, see check_instances
+        "reference_route": reference,
+        "location_addresses": [f"Synthetic stop {i}" for i in range(n)],
+        "location_names": ["Home"] + [f"Stop {i}" for i in range(1, n)],
+        "location_durations": durations,
+        "time_windows": time_windows,
+        "depot": 0,
+        "depot_departure_window": [420, 600],
+        "depot_return_window": [0, 1439],
+        "precedence_constraints": [],
+        "num_vehicles": 1,
+        "location_coords": coords.tolist(),
+        "time_matrix": time_matrix.tolist(),
+        "distance_matrix": distance_matrix,
+    }
+    if "custom_end" in variant:
+        data["custom_end_index"] = reference[-1]
+    if "precedence" in variant and num_stops >= 3:
+        # pairs follow the reference tour, so they agree with the windows and never form a cycle
+        position = {node: k for k, node in enumerate(reference)}
+        candidates = [node for node in reference[1:] if node != data.get("custom_end_index")]
+        for _ in range(max(1, num_stops // 10)):
+            pair = rng.choice(candidates, size=2, replace=False).tolist()
+            a, b = sorted(pair, key=position.get)
+            data["precedence_constraints"].append([data["location_names"][a], data["location_names"][b]])
+    return data
+
+
+def random_transit_data(num_nodes, seed=0):
+    """Minimal single-vehicle data dict with random symmetric travel times and wide windows."""
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 60, size=(num_nodes, 2))
+    time_matrix = np.rint(np.linalg.norm(points[:, None] - points[None, :], axis=-1)).astype(int)
+    return {
+        "time_matrix": time_matrix.tolist(),
+        "location_durations": [0] + rng.integers(5, 30, size=num_nodes - 1).tolist(),
+        "depot": 0,
+        "num_vehicles": 1,
+    }
+
+
+def _solve_with_transit(data, use_matrix, time_limit):
+    manager = pywrapcp.RoutingIndexManager(len(data["time_matrix"]), 1, data["depot"])
+    routing = pywrapcp.RoutingModel(manager)
+
+    if use_matrix:
+        transit_cb = routing.RegisterTransitMatrix(build_transit_matrix(data).tolist())
+    else:
+        # the Python closure solve_vrptw used before the transit matrix
+        def time_callback(from_index, to_index):
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            travel_time = data["time_matrix"][from_node][to_node]
+            service_time = data["location_durations"][from_node] if from_node != data["depot"] else 0
+            return travel_time + service_time
+
+        transit_cb = routing.RegisterTransitCallback(time_callback)
+
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_cb)
+    routing.AddDimension(transit_cb, 10000, 100000, False, "Time")
+
+    search_params = pywrapcp.DefaultRoutingSearchParameters()
+    search_params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    search_params.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GREEDY_DESCENT
+    search_params.time_limit.FromMilliseconds(int(time_limit * 1000))
+
+    start = time.perf_counter()
+    solution = routing.SolveWithParameters(search_params)
+    elapsed = time.perf_counter() - start
+    return elapsed, solution.ObjectiveValue() if solution else None
+
+
+def bench_transit(node_counts, repeats=3, time_limit=60):
+    """Solve time of the Python transit callback against RegisterTransitMatrix on the same instances."""
+    print(f"{'nodes':>6} {'callback s':>11} {'matrix s':>9} {'speedup':>8} {'objective':>10}")
+    for num_nodes in node_counts:
+        data = random_transit_data(num_nodes)
+        callback_times, matrix_times = [], []
+        for _ in range(repeats):
+            elapsed, callback_objective = _solve_with_transit(data, False, time_limit)
+            callback_times.append(elapsed)
+            elapsed, matrix_objective = _solve_with_transit(data, True, time_limit)
+            matrix_times.append(elapsed)
+        if callback_objective != matrix_objective:
+            print(f"Warning: objectives differ for {num_nodes} nodes: {callback_objective} vs {matrix_objective}")
+        callback_s, matrix_s = min(callback_times), min(matrix_times)
+        print(f"{num_nodes:>6} {callback_s:>11.3f} {matrix_s:>9.3f} {callback_s / matrix_s:>7.1f}x {matrix_objective:>10}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_instance(data, profile=None, time_limit=None, solve=solve_vrptw):
+    """Solve one instance and record time, objective, feasibility and memory."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    manager, routing, solution, failed = solve(data, profile=profile, time_limit=time_limit)
+    elapsed = time.perf_counter() - start
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "solve_seconds": round(elapsed, 4),
+        "feasible": not failed,
+        "objective": solution.ObjectiveValue() if not failed else None,
+        "python_peak_mb": round(python_peak / 2**20, 2),
+        # process-wide high-water mark, includes OR-Tools' native allocations (KiB on Linux)
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_suite(sizes, tightness_levels, variants, seeds, profile=None, time_limit=None):
+    results = []
+    for num_stops in sizes:
+        for tightness in tightness_levels:
+            for variant in variants:
+                for seed in range(seeds):
+                    data = synthetic_instance(num_stops, tightness, variant, seed)
+                    record = {"stops": num_stops, "tightness": tightness, "variant": variant, "seed": seed}
+                    record.update(bench_instance(data, profile, time_limit))
+                    results.append(record)
+                    print(
+                        f"{num_stops:>4} stops {tightness:>6} {variant:<22} seed {seed}: "
+                        f"{record['solve_seconds']:.3f}s feasible={record['feasible']} objective={record['objective']}"
+                    )
+    return results
+
+
+def summarize_results(results):
+    """Per (stops, tightness) aggregates: median/max solve time, feasibility rate, mean objective."""
+    groups = {}
+    for record in results:
+        groups.setdefault((record["stops"], record["tightness"]), []).append(record)
+    summary = []
+    for (num_stops, tightness), records in sorted(groups.items()):
+        objectives = [r["objective"] for r in records if r["feasible"]]
+        summary.append({
+            "stops": num_stops,
+            "tightness": tightness,
+            "instances": len(records),
+            "median_solve_seconds": round(statistics.median(r["solve_seconds"] for r in records), 4),
+            "max_solve_seconds": max(r["solve_seconds"] for r in records),
+            "feasibility_rate": round(len(objectives) / len(records), 3),
+            "mean_objective": round(statistics.mean(objectives), 1) if objectives else None,
+        })
+    return summary
+
+
+def write_report(results, path, args):
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "ortools": ortools.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "profile": args.profile,
+            "time_limit": args.time_limit,
+        },
+        "summary": summarize_results(results),
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Report written to {path}")
+    return report
+
+
+def compare_reports(old_path, new_path):
+    """Per-instance solve time ratio and objective change between two suite reports."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def key(record):
+        return record["stops"], record["tightness"], record["variant"], record["seed"]
+
+    old_results = {key(r): r for r in old["results"]}
+    print(f"{'stops':>5} {'tightness':>9} {'variant':<22} {'seed':>4} {'time old→new':>18} {'objective old→new':>22}")
+    for record in new["results"]:
+        before = old_results.get(key(record))
+        if before is None:
+            continue
+        times = f"{before['solve_seconds']:.3f}→{record['solve_seconds']:.3f}"
+        objectives = f"{before['objective']}→{record['objective']}"
+        print(f"{record['stops']:>5} {record['tightness']:>9} {record['variant']:<22} {record['seed']:>4} {times:>18} {objectives:>22}")
+
+
+def check_instances(sizes, tightness_levels, variants, seeds):
+    """
+    Confirms every synthetic instance is feasible by loading its reference tour into the full model.
+    Returns the (stops, tightness, variant, seed) of any that are not.
+    """
+    infeasible = []
+    for num_stops in sizes:
+        for tightness in tightness_levels:
+            for variant in variants:
+                for seed in range(seeds):
+                    data = synthetic_instance(num_stops, tightness, variant, seed)
+                    route = data["reference_route"] + [data.get("custom_end_index", data["depot"])]
+                    if not routes_are_feasible(data, [route]):
+                        infeasible.append((num_stops, tightness, variant, seed))
+                        print(f"❌ {num_stops} stops {tightness} {variant} seed {seed}: reference tour is infeasible")
+    total = len(sizes) * len(tightness_levels) * len(variants) * seeds
+    print(f"{total - len(infeasible)}/{total} instances feasible")
+    return infeasible
+
+
+def bench_decomposition(sizes, tightness_levels, seeds, profile=None, time_limit=None, workers=DECOMPOSE_WORKERS):
+    """
+    Monolithic solve_vrptw against solve_decomposed on the same instances. Objectives are only
+    comparable when both are hard-feasible; a soft decomposed plan is flagged with its bent stops.
+    """
+    def decomposed(data, profile=None, time_limit=None):
+        return solve_decomposed(data, profile, polish_seconds=time_limit, workers=workers)
+
+    print(f"{'stops':>5} {'tightness':>9} {'seed':>4} {'monolithic s':>12} {'objective':>10} "
+          f"{'decomposed s':>12} {'objective':>10} {'gap':>7}")
+    results = []
+    for num_stops in sizes:
+        for tightness in tightness_levels:
+            for seed in range(seeds):
+                monolithic = bench_instance(synthetic_instance(num_stops, tightness, "round_trip", seed), profile, time_limit)
+                data = synthetic_instance(num_stops, tightness, "round_trip", seed)
+                split = bench_instance(data, profile, time_limit, solve=decomposed)
+                if data["solved_soft"]:
+                    split["feasible"] = False
+                gap = None
+                if monolithic["feasible"] and split["feasible"]:
+                    gap = (split["objective"] - monolithic["objective"]) / monolithic["objective"]
+                results.append({
+                    "stops": num_stops, "tightness": tightness, "seed": seed,
+                    "monolithic": monolithic, "decomposed": split, "objective_gap": gap,
+                })
+                print(
+                    f"{num_stops:>5} {tightness:>9} {seed:>4} {monolithic['solve_seconds']:>12.3f} "
+                    f"{str(monolithic['objective'] if monolithic['feasible'] else '-'):>10} "
+                    f"{split['solve_seconds']:>12.3f} {str(split['objective'] if split['feasible'] else '-'):>10} "
+                    f"{'' if gap is None else f'{gap:+.1%}':>7}"
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    transit = subparsers.add_parser("transit", help="Python transit callback vs RegisterTransitMatrix")
+    transit.add_argument("--nodes", type=int, nargs="+", default=[25, 50, 100, 200])
+    transit.add_argument("--repeats", type=int, default=3)
+
+    suite = subparsers.add_parser("suite", help="solve_vrptw over synthetic VRPTW instances")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 25, 50, 100, 200, 500])
+    suite.add_argument("--tightness", nargs="+", choices=list(WINDOW_TIGHTNESS), default=list(WINDOW_TIGHTNESS))
+    suite.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    suite.add_argument("--seeds", type=int, default=1)
+    suite.add_argument("--profile", default=None, help="search profile, defaults to SEARCH_PROFILE")
+    suite.add_argument("--time-limit", type=float, default=None, help="fixed solver time limit in seconds")
+    suite.add_argument("--output", default="bench_report.json")
+
+    decompose = subparsers.add_parser("decompose", help="monolithic vs cluster-first solves on large instances")
+    decompose.add_argument("--sizes", type=int, nargs="+", default=[100, 200])
+    decompose.add_argument("--tightness", nargs="+", choices=list(WINDOW_TIGHTNESS), default=list(WINDOW_TIGHTNESS))
+    decompose.add_argument("--seeds", type=int, default=1)
+    decompose.add_argument("--profile", default=None, help="search profile, defaults to SEARCH_PROFILE")
+    decompose.add_argument("--time-limit", type=float, default=None,
+                           help="monolithic time limit and decomposed polish budget, in seconds")
+    decompose.add_argument("--workers", type=int, default=DECOMPOSE_WORKERS)
+    decompose.add_argument("--output", default=None, help="also write the results as JSON to this path")
+
+    check = subparsers.add_parser("check", help="confirm every synthetic instance has a feasible route")
+    check.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 25, 50, 100, 200, 500])
+    check.add_argument("--tightness", nargs="+", choices=list(WINDOW_TIGHTNESS), default=list(WINDOW_TIGHTNESS))
+    check.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    check.add_argument("--seeds", type=int, default=1)
+
+    compare = subparsers.add_parser("compare", help="compare two suite reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "transit":
+        bench_transit(args.nodes, args.repeats)
+    elif args.command == "suite":
+        results = run_suite(args.sizes, args.tightness, args.variants, args.seeds, args.profile, args.time_limit)
+        write_report(results, args.output, args)
+    elif args.command == "decompose":
+        results = bench_decomposition(
+            args.sizes, args.tightness, args.seeds, args.profile, args.time_limit, args.workers
+        )
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+    elif args.command == "check":
+        if check_instances(args.sizes, args.tightness, args.variants, args.seeds):
+            raise SystemExit(1)
+    elif args.command == "compare":
+        compare_reports(args.old, args.new)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+CACHE_PATH = os.getenv("ROUTE_CACHE_PATH", os.path.join(".cache", "route_cache.sqlite3"))
+# a namespace may grow this fraction past max_entries before it is trimmed back, so eviction is occasional
+CACHE_EVICT_SLACK = float(os.getenv("CACHE_EVICT_SLACK", 0.1))
+
+
+def normalize_address(address):
+    """Canonical form of an address used as a cache key (case, spacing and comma insensitive)."""
+    address = re.sub(r"\s*,\s*", ", ", address.strip().lower())
+    return re.sub(r"\s+", " ", address).strip(" ,.")
+
+
+class SqliteCache:
+    """
+    Small persistent key/value cache backed by SQLite.
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted once a namespace holds more than `max_entries` rows (plus CACHE_EVICT_SLACK).
+    Values must be JSON serialisable.
+    """
+
+    def __init__(self, namespace, ttl=None, max_entries=None, path=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path or CACHE_PATH
+        self.hits = 0
+        self.misses = 0
+        # keyed by process id: a forked job must not reuse its parent's connection, or a lock
+        # another of the parent's threads held at fork time
+        self._conns = {}
+        self._locks = {}
+        # rows written since the namespace was last counted; an upper bound, as replacements count too
+        self._size = None
+
+    @property
+    def _lock(self):
+        return self._locks.setdefault(os.getpid(), threading.Lock())
+
+    def _connect(self):
+        """This process's connection, opened on first use; call with self._lock held."""
+        conn = self._conns.get(os.getpid())
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = self._conns[os.getpid()] = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_ttl ON cache (namespace, created_at)"
+            )
+            conn.commit()
+        return conn
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return {key: value} for every key that is cached and not expired."""
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            # SQLite caps the number of bound parameters per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, value, created_at FROM cache WHERE namespace = ? AND key IN ({placeholders})",
+                    [self.namespace, *chunk],
+                ).fetchall()
+                for key, value, created_at in rows:
+                    if self.ttl is not None and now - created_at > self.ttl:
+                        continue
+                    found[key] = json.loads(value)
+            if found:
+                conn.executemany(
+                    "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(now, self.namespace, key) for key in found],
+                )
+                conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [(self.namespace, key, json.dumps(value), now, now) for key, value in items.items()],
+            )
+            if self._size is not None:
+                self._size += len(items)
+            self._evict(conn, now)
+            conn.commit()
+
+    def _count(self, conn):
+        return conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def _evict(self, conn, now):
+        if self.ttl is not None:
+            # a range scan on cache_ttl, empty unless something has expired
+            conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+                (self.namespace, now - self.ttl),
+            )
+        if self.max_entries is None:
+            return
+        limit = int(self.max_entries * (1 + CACHE_EVICT_SLACK))
+        if self._size is not None and self._size <= limit:
+            return
+        self._size = self._count(conn)
+        if self._size <= limit:
+            return
+        # drop everything older than the max_entries-th most recently used row
+        conn.execute(
+            """DELETE FROM cache WHERE namespace = ? AND accessed_at < (
+                SELECT accessed_at FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT 1 OFFSET ?
+            )""",
+            (self.namespace, self.namespace, self.max_entries - 1),
+        )
+        self._size = self._count(conn)
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+            self._size = 0
+        self.hits = self.misses = 0
+
+    def size(self):
+        with self._lock:
+            return self._count(self._connect())
+
+    def stats(self):
+        """Hit/miss counters since process start, plus the number of stored entries."""
+        return {"hits": self.hits, "misses": self.misses, "size": self.size()}
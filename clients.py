@@ -0,0 +1,53 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+GOOGLEMAPS_API_KEY = os.getenv("GOOGLEMAPS_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# keep-alive connections per client; matches the thread pools that share it
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", os.getenv("MAX_CONCURRENT_REQUESTS", 8)))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _shared(name, build):
+    # keyed by process id: a forked worker must not reuse its parent's open connections
+    key = (os.getpid(), name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = build()
+    return client
+
+
+def get_gmaps_client(key=None):
+    """
+    The process-wide googlemaps client, built on first use. Its requests session keeps
+    connections alive and its rate limiter is shared by every caller in the process.
+    """
+    key = key or GOOGLEMAPS_API_KEY
+
+    def build():
+        import googlemaps
+        from requests.adapters import HTTPAdapter
+
+        client = googlemaps.Client(key=key)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        client.session.mount("https://", adapter)
+        return client
+
+    return _shared(("googlemaps", key), build)
+
+
+def get_openai_client():
+    """The process-wide OpenAI client (one pooled keep-alive HTTP client), built on first use."""
+    def build():
+        import openai
+
+        return openai.OpenAI(api_key=OPENAI_API_KEY)
+
+    return _shared(("openai",), build)
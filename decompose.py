@@ -0,0 +1,294 @@
+"""
+Cluster-first, route-second solving for days with hundreds of stops.
+
+Stops are grouped by location and by when they are open, each group is solved as a small
+path in its own worker process, and the paths are chained into one route per vehicle.
+The chained routes then warm-start a time-bounded local search over the full model.
+"""
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from ortools.constraint_solver import pywrapcp
+from tracing import annotate, incr, logger, span
+
+load_dotenv()
+# off: always solve the whole model; auto: decompose from DECOMPOSE_MIN_STOPS stops; always: decompose whenever possible
+DECOMPOSITION = os.getenv("DECOMPOSITION", "auto")
+DECOMPOSITION_MODES = ("off", "auto", "always")
+DECOMPOSE_MIN_STOPS = int(os.getenv("DECOMPOSE_MIN_STOPS", 150))
+DECOMPOSE_CLUSTER_SIZE = int(os.getenv("DECOMPOSE_CLUSTER_SIZE", 40))
+DECOMPOSE_WORKERS = int(os.getenv("DECOMPOSE_WORKERS", os.cpu_count() or 1))
+DECOMPOSE_POLISH_SECONDS = float(os.getenv("DECOMPOSE_POLISH_SECONDS", 10))
+# how many km one minute of difference in opening hours counts for when clustering (roughly city driving speed)
+CLUSTER_KM_PER_MINUTE = 0.5
+KMEANS_ITERATIONS = 25
+DAY = [0, 1439]
+
+
+def should_decompose(data, mode=None):
+    """Whether solve_route should use solve_decomposed for this data dict."""
+    mode = mode or data.get("decomposition") or DECOMPOSITION
+    if mode not in DECOMPOSITION_MODES:
+        raise ValueError(f"Unknown decomposition mode '{mode}', expected one of {', '.join(DECOMPOSITION_MODES)}")
+    if mode == "off" or not data.get("location_coords"):
+        return False
+    num_stops = len(data["time_matrix"]) - len(_endpoints(data))
+    geocoded = len(_geocoded(data, range(len(data["time_matrix"])))) - len(_endpoints(data))
+    return geocoded >= 2 * DECOMPOSE_CLUSTER_SIZE and (mode == "always" or num_stops >= DECOMPOSE_MIN_STOPS)
+
+
+def _endpoints(data):
+    from vrptw import vehicle_starts_ends
+
+    starts, ends = vehicle_starts_ends(data)
+    return set(starts) | set(ends)
+
+
+def _geocoded(data, nodes):
+    """The nodes with coordinates; geocode_addresses gives (None, None) for an address it could not find."""
+    coords = data["location_coords"]
+    return [i for i in nodes if coords[i] is not None and None not in coords[i] and not np.isnan(coords[i]).any()]
+
+
+def _features(data, nodes):
+    """Points in km (equirectangular around the mean latitude) plus the scaled window midpoint."""
+    coords = np.asarray([data["location_coords"][i] for i in nodes], dtype=float)
+    km_per_degree = 111.32
+    lat = coords[:, 0] * km_per_degree
+    lon = coords[:, 1] * km_per_degree * np.cos(np.radians(coords[:, 0].mean()))
+    midpoints = np.asarray([sum(data["time_windows"][i]) / 2 for i in nodes])
+    return np.column_stack([lat, lon, midpoints * CLUSTER_KM_PER_MINUTE])
+
+
+def kmeans(points, k, seed=0, iterations=KMEANS_ITERATIONS):
+    """Labels from k-means with k-means++ seeding; empty clusters are reseeded on the farthest point."""
+    rng = np.random.default_rng(seed)
+    centers = [points[rng.integers(len(points))]]
+    for _ in range(1, k):
+        distances = np.min([((points - c) ** 2).sum(axis=1) for c in centers], axis=0)
+        centers.append(points[rng.choice(len(points), p=distances / distances.sum())])
+    centers = np.asarray(centers)
+
+    labels = None
+    for _ in range(iterations):
+        distances = ((points[:, None] - centers[None]) ** 2).sum(axis=-1)
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for c in range(k):
+            members = points[labels == c]
+            if len(members):
+                centers[c] = members.mean(axis=0)
+            else:
+                centers[c] = points[distances.min(axis=1).argmax()]
+    return labels
+
+
+def cluster_stops(data, cluster_size=DECOMPOSE_CLUSTER_SIZE):
+    """
+    Stops (endpoints excluded) grouped into clusters of about `cluster_size`, ordered by when they
+    are open and, for stops open at the same times, by bearing around the depot (a sweep).
+    Stops without coordinates join the cluster of the geocoded stop they are quickest to reach.
+    """
+    endpoints = _endpoints(data)
+    nodes = [i for i in range(len(data["time_matrix"])) if i not in endpoints]
+    located = _geocoded(data, nodes)
+    k = max(1, round(len(nodes) / cluster_size))
+    labels = kmeans(_features(data, located), k)
+
+    clusters = [[node for node, label in zip(located, labels) if label == c] for c in range(k)]
+    time_matrix = data["time_matrix"]
+    located_set = set(located)
+    for node in nodes:
+        if node not in located_set:
+            nearest = min(located, key=lambda j: time_matrix[node][j] + time_matrix[j][node])
+            clusters[labels[located.index(nearest)]].append(node)
+    clusters = [cluster for cluster in clusters if cluster]
+
+    depot = data["location_coords"][data["depot"]]
+    if not _geocoded(data, [data["depot"]]):
+        depot = np.mean([data["location_coords"][i] for i in located], axis=0)
+    depot_lat, depot_lon = depot
+
+    def order(cluster):
+        midpoint = np.mean([sum(data["time_windows"][i]) / 2 for i in cluster])
+        lat, lon = np.mean([data["location_coords"][i] for i in _geocoded(data, cluster)], axis=0)
+        return midpoint, np.arctan2(lat - depot_lat, lon - depot_lon)
+
+    return sorted(clusters, key=order)
+
+
+def subproblem(data, nodes, start, end=None):
+    """
+    Data dict for a path from `start` through `nodes` to `end`: one of the nodes (where the next cluster
+    takes over), the vehicle's end, or None for a free dummy end. Departure is unconstrained, since the
+    path is chained after other clusters, and only precedence pairs inside the cluster are kept.
+    Returns (sub, index) where index maps sub nodes to full-problem nodes (None for the dummy).
+    """
+    from vrptw import DEFAULT_PRIORITY
+
+    stops = [node for node in nodes if node != end]
+    index = [start] + stops + [end]
+    real = [node if node is not None else start for node in index]
+    time_matrix = np.asarray(data["time_matrix"])[np.ix_(real, real)]
+    distance_matrix = np.asarray(data["distance_matrix"])[np.ix_(real, real)]
+    if end is None:
+        # the dummy end is zero minutes from everywhere, so the path may finish at any stop
+        time_matrix[:, -1] = time_matrix[-1, :] = 0
+        distance_matrix[:, -1] = distance_matrix[-1, :] = 0
+    end_is_stop = end in nodes
+    names = [data["location_names"][i] for i in [start] + stops]
+    names.append(data["location_names"][end] if end is not None else "End")
+    inside = set(names)
+    durations = [0] + [data["location_durations"][i] for i in stops]
+    durations.append(data["location_durations"][end] if end_is_stop else 0)
+    windows = [DAY] + [data["time_windows"][i] for i in stops]
+    windows.append(data["time_windows"][end] if end_is_stop else DAY)
+    sub = {
+        "location_names": names,
+        "location_durations": durations,
+        "time_windows": windows,
+        "time_matrix": time_matrix.tolist(),
+        "distance_matrix": distance_matrix.tolist(),
+        "depot": 0,
+        "custom_end_index": len(index) - 1,
+        "depot_departure_window": DAY,
+        "depot_return_window": DAY,
+        "precedence_constraints": [
+            pair for pair in data.get("precedence_constraints", []) if pair[0] in inside and pair[1] in inside
+        ],
+        "num_vehicles": 1,
+    }
+    if "location_priorities" in data:
+        sub["location_priorities"] = (
+            [DEFAULT_PRIORITY] + [data["location_priorities"][i] for i in stops] + [DEFAULT_PRIORITY]
+        )
+    return sub, index
+
+
+def solve_subproblem(sub, index, profile=None):
+    """
+    Worker entry point: the visit order of one cluster, in the full problem's node indices.
+    Solved with soft windows so a path always comes back; stops it drops are put just before the
+    hand-off stop for the polish to place.
+    """
+    from vrptw import extract_visit_order, solve_vrptw
+
+    manager, routing, solution, failed = solve_vrptw(sub, profile, soft=True)
+    order = [] if failed else extract_visit_order(manager, routing, solution)[1:-1]
+    path = [index[node] for node in order]
+    visited = set(path)
+    dropped = [node for node in index[1:-1] if node not in visited]
+    return path + dropped
+
+
+def handoff_stops(data, clusters, num_vehicles):
+    """
+    For each cluster followed by another on the same vehicle, the stop closest (in travel time) to that
+    next cluster: the path ends there and the next cluster's path starts from it. None for last clusters.
+    """
+    time_matrix = np.asarray(data["time_matrix"])
+    handoffs = []
+    for c, cluster in enumerate(clusters):
+        if c + num_vehicles >= len(clusters):
+            handoffs.append(None)
+            continue
+        to_next = time_matrix[np.ix_(cluster, clusters[c + num_vehicles])].min(axis=1)
+        handoffs.append(cluster[int(to_next.argmin())])
+    return handoffs
+
+
+def stitched_routes(data, clusters, profile=None, workers=DECOMPOSE_WORKERS):
+    """
+    One visit order per vehicle: cluster c goes to vehicle c % num_vehicles, so every driver works
+    through the day's clusters in order. Each cluster's path runs from the previous cluster's hand-off
+    stop (or the vehicle's start) to its own hand-off stop (or the vehicle's end), so the paths are
+    solved in parallel yet join up. Inside a pool worker (a JobQueue or batch.py job) they are solved
+    in-process rather than starting a pool per job.
+    """
+    from vrptw import vehicle_starts_ends
+
+    starts, ends = vehicle_starts_ends(data)
+    num_vehicles = data["num_vehicles"]
+    handoffs = handoff_stops(data, clusters, num_vehicles)
+    jobs = []
+    for c, cluster in enumerate(clusters):
+        v = c % num_vehicles
+        start = handoffs[c - num_vehicles] if c >= num_vehicles else starts[v]
+        end = handoffs[c] if handoffs[c] is not None else ends[v]
+        jobs.append(subproblem(data, cluster, start, end))
+
+    if multiprocessing.parent_process() is not None:
+        workers = 1
+    workers = min(workers, len(jobs))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            paths = list(pool.map(solve_subproblem, *zip(*jobs), [profile] * len(jobs)))
+    else:
+        paths = [solve_subproblem(sub, index, profile) for sub, index in jobs]
+
+    routes = [[starts[v]] for v in range(num_vehicles)]
+    for c, path in enumerate(paths):
+        routes[c % num_vehicles].extend(path)
+        if handoffs[c] is not None:
+            routes[c % num_vehicles].append(handoffs[c])
+    for v, route in enumerate(routes):
+        route.append(ends[v])
+    return routes
+
+
+def routes_are_feasible(data, routes, soft=False):
+    """Whether the routes satisfy every hard constraint of the full model."""
+    from vrptw import build_routing_model, vehicle_starts_ends
+
+    manager, routing = build_routing_model(data, soft=soft)
+    routing.CloseModelWithParameters(pywrapcp.DefaultRoutingSearchParameters())
+    starts, ends = vehicle_starts_ends(data)
+    endpoints = set(starts) | set(ends)
+    indices = [[manager.NodeToIndex(node) for node in route if node not in endpoints] for route in routes]
+    return routing.ReadAssignmentFromRoutes(indices, True) is not None
+
+
+def solve_decomposed(data, profile=None, soft_constraints=None, polish_seconds=None, workers=DECOMPOSE_WORKERS,
+                     **kwargs):
+    """
+    Cluster-first, route-second solve with the same return value as solve_vrptw.
+    The stitched routes warm-start the full model, whose search is capped at DECOMPOSE_POLISH_SECONDS.
+    When the stitched routes break a window (a cluster boundary reached too late), they are first repaired
+    with soft windows for half that budget; if that leaves nothing bent the rest polishes under hard windows,
+    otherwise it is returned as a soft solution, as solve_plan would. SOFT_CONSTRAINTS=off solves the
+    full model from scratch instead.
+    """
+    from vrptw import SOFT_CONSTRAINTS, bent_constraints, extract_visit_orders, solve_vrptw
+
+    kwargs.pop("initial_routes", None)
+    mode = soft_constraints or SOFT_CONSTRAINTS
+    data["soft_fallback"] = False
+    time_limit = kwargs.pop("time_limit", None)
+    polish_seconds = polish_seconds or time_limit or DECOMPOSE_POLISH_SECONDS
+    with span("cluster"):
+        clusters = cluster_stops(data)
+    with span("subproblems"):
+        routes = stitched_routes(data, clusters, profile, workers)
+    annotate(decomposed=True, clusters=len(clusters))
+    incr("solver.decomposed")
+
+    if mode == "always" or not routes_are_feasible(data, routes):
+        if mode == "off":
+            logger.warning("Stitched routes break a hard constraint, solving the full model from scratch")
+            return solve_vrptw(data, profile, time_limit=time_limit, **kwargs)
+        incr("solver.decomposition_repairs")
+        polish_seconds /= 2
+        manager, routing, solution, failed = solve_vrptw(
+            data, profile, time_limit=polish_seconds, initial_routes=routes, soft=True, **kwargs
+        )
+        bent = None if failed else bent_constraints(data, manager, routing, solution)
+        if failed or mode == "always" or bent["dropped"] or bent["late"]:
+            data["soft_fallback"] = mode != "always"
+            return manager, routing, solution, failed
+        routes = extract_visit_orders(manager, routing, solution)
+
+    return solve_vrptw(data, profile, time_limit=polish_seconds, initial_routes=routes, **kwargs)
@@ -0,0 +1,382 @@
+import copy
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+from itinerary import minutes_to_clock
+from maps import UNREACHABLE_MINUTES
+
+# each relaxation step is one first-solution search, so cap how many are attempted
+MAX_RELAXATION_CHECKS = 40
+CHECK_TIME_LIMIT_MS = 200
+# a check that ends with one of these found no route; running out of time proves nothing
+NO_ROUTE_STATUSES = (
+    routing_enums_pb2.RoutingSearchStatus.ROUTING_FAIL,
+    routing_enums_pb2.RoutingSearchStatus.ROUTING_INFEASIBLE,
+)
+# the relaxed route pays this much per minute a softened constraint is missed
+RELAXED_PENALTY = 100
+RELAXED_TIME_LIMIT_MS = 1000
+
+
+def _vehicle_bounds(data):
+    """
+    Per-vehicle (start node, end node, earliest departure, latest arrival at the end).
+    A shift replaces the depot windows, and a custom end keeps its window, as in build_routing_model.
+    """
+    from vrptw import vehicle_starts_ends
+
+    starts, ends = vehicle_starts_ends(data)
+    shifts = data.get("vehicle_shifts")
+    start_nodes = set(starts)
+    bounds = []
+    for v in range(data["num_vehicles"]):
+        departure = shifts[v] if shifts else data["depot_departure_window"]
+        earliest = max(data["time_windows"][starts[v]][0], departure[0])
+        latest = shifts[v][1] if shifts else data["depot_return_window"][1]
+        if ends[v] not in start_nodes:
+            # a custom end keeps its own closing time, shift or not
+            latest = min(latest, data["time_windows"][ends[v]][1]) if shifts else data["time_windows"][ends[v]][1]
+        bounds.append((starts[v], ends[v], earliest, latest))
+    return bounds
+
+
+def _precedence_cycles(data):
+    """Lists of stop names that must each come before the next and, in the end, before themselves."""
+    graph = {}
+    for before, after in data.get("precedence_constraints", []):
+        graph.setdefault(before, []).append(after)
+
+    cycles = []
+    state = {}
+
+    def visit(name, path):
+        state[name] = "open"
+        path.append(name)
+        for nxt in graph.get(name, []):
+            if state.get(nxt) == "open":
+                cycles.append(path[path.index(nxt):] + [nxt])
+            elif nxt not in state:
+                visit(nxt, path)
+        path.pop()
+        state[name] = "done"
+
+    for name in list(graph):
+        if name not in state:
+            visit(name, [])
+    return cycles
+
+
+def check_constraints(data):
+    """
+    Fast, solver-free checks over the travel matrix, windows, durations and depot windows.
+    Returns a list of {"kind", "constraints", "reason"} conflicts; "constraints" names the
+    constraint ids involved (see relaxable_constraints).
+    """
+    names = data["location_names"]
+    windows = data["time_windows"]
+    durations = data["location_durations"]
+    time_matrix = data["time_matrix"]
+    bounds = _vehicle_bounds(data)
+    endpoints = {node for start, end, _, _ in bounds for node in (start, end)}
+    conflicts = []
+
+    shifts = data.get("vehicle_shifts")
+    start_nodes = {start for start, _, _, _ in bounds}
+    for v, (start, end, earliest, latest) in enumerate(bounds):
+        departure = shifts[v] if shifts else data["depot_departure_window"]
+        label = f"Driver {v}'s shift" if shifts else "The departure window"
+        if earliest > departure[1] or earliest > windows[start][1]:
+            conflicts.append({
+                "kind": "depot_window",
+                "constraints": ["depot_departure", f"window:{start}"],
+                "reason": f"{label} {minutes_to_clock(departure[0])}–{minutes_to_clock(departure[1])} "
+                          f"does not overlap the opening hours of {names[start]}.",
+            })
+        if end not in start_nodes and windows[end][0] > latest:
+            conflicts.append({
+                "kind": "depot_window",
+                "constraints": [],
+                "reason": f"{label} ends at {minutes_to_clock(latest)}, before {names[end]} opens at "
+                          f"{minutes_to_clock(windows[end][0])}.",
+            })
+        if latest < earliest:
+            conflicts.append({
+                "kind": "depot_window",
+                "constraints": ["depot_departure", "depot_return"],
+                "reason": f"The route must end by {minutes_to_clock(latest)} but cannot leave before "
+                          f"{minutes_to_clock(earliest)}.",
+            })
+
+    # each stop on its own: reachable before it closes, and home again in time afterwards
+    earliest_arrival = {}
+    for i, (open_time, close_time) in enumerate(windows):
+        if i in endpoints:
+            continue
+        options = [
+            (earliest + time_matrix[start][i], start, end, latest)
+            for start, end, earliest, latest in bounds
+        ]
+        arrival, start, end, latest = min(options)
+        if time_matrix[start][i] >= UNREACHABLE_MINUTES or time_matrix[i][end] >= UNREACHABLE_MINUTES:
+            # left out of earliest_arrival, so the pair and precedence checks do not report its fake drive
+            conflicts.append({
+                "kind": "unreachable",
+                "constraints": [],
+                "reason": f"{names[i]} ({data['location_addresses'][i]}) could not be routed to or from {names[start]}.",
+            })
+            continue
+        earliest_arrival[i] = max(arrival, open_time)
+        if arrival > close_time:
+            conflicts.append({
+                "kind": "window_unreachable",
+                "constraints": [f"window:{i}", "depot_departure"],
+                "reason": f"{names[i]} closes at {minutes_to_clock(close_time)}, but the earliest possible arrival is "
+                          f"{minutes_to_clock(arrival)} ({time_matrix[start][i]} min from {names[start]}, "
+                          f"leaving at {minutes_to_clock(arrival - time_matrix[start][i])}).",
+            })
+        else:
+            back = earliest_arrival[i] + durations[i] + time_matrix[i][end]
+            if back > latest:
+                conflicts.append({
+                    "kind": "return_too_late",
+                    "constraints": [f"window:{i}", "depot_return"],
+                    "reason": f"After {durations[i]} min at {names[i]} (from {minutes_to_clock(earliest_arrival[i])} "
+                              f"at the earliest), {names[end]} is reached at {minutes_to_clock(back)} at the earliest, "
+                              f"past the required {minutes_to_clock(latest)}.",
+                })
+
+    # pairs of stops one vehicle cannot visit in either order
+    if data["num_vehicles"] == 1:
+        stops = sorted(earliest_arrival)
+        for a_pos, a in enumerate(stops):
+            for b in stops[a_pos + 1:]:
+                a_then_b = earliest_arrival[a] + durations[a] + time_matrix[a][b] <= windows[b][1]
+                b_then_a = earliest_arrival[b] + durations[b] + time_matrix[b][a] <= windows[a][1]
+                if not a_then_b and not b_then_a:
+                    conflicts.append({
+                        "kind": "window_pair",
+                        "constraints": [f"window:{a}", f"window:{b}"],
+                        "reason": f"{names[a]} ({minutes_to_clock(windows[a][0])}–{minutes_to_clock(windows[a][1])}) and "
+                                  f"{names[b]} ({minutes_to_clock(windows[b][0])}–{minutes_to_clock(windows[b][1])}) "
+                                  f"cannot both be visited: the stays plus the "
+                                  f"{min(time_matrix[a][b], time_matrix[b][a])} min drive do not fit either way round.",
+                    })
+
+    for k, (before, after) in enumerate(data.get("precedence_constraints", [])):
+        a, b = names.index(before), names.index(after)
+        if a in earliest_arrival and earliest_arrival[a] + durations[a] > windows[b][1]:
+            conflicts.append({
+                "kind": "precedence_window",
+                "constraints": [f"precedence:{k}", f"window:{a}", f"window:{b}"],
+                "reason": f"{before} must come before {after}, but {before} cannot be finished before "
+                          f"{minutes_to_clock(earliest_arrival[a] + durations[a])} and {after} closes at "
+                          f"{minutes_to_clock(windows[b][1])}.",
+            })
+    for cycle in _precedence_cycles(data):
+        conflicts.append({
+            "kind": "precedence_cycle",
+            "constraints": [
+                f"precedence:{k}" for k, pair in enumerate(data.get("precedence_constraints", []))
+                if any(list(pair) == cycle[i:i + 2] for i in range(len(cycle) - 1))
+            ],
+            "reason": f"The precedence constraints form a cycle: {' → '.join(cycle)}.",
+        })
+
+    if "vehicle_capacities" in data:
+        demands = data["location_demands"]
+        capacities = data["vehicle_capacities"]
+        if sum(demands) > sum(capacities):
+            conflicts.append({
+                "kind": "capacity",
+                "constraints": [],
+                "reason": f"The stops need {sum(demands)} units in total but the fleet carries {sum(capacities)}.",
+            })
+        for i, demand in enumerate(demands):
+            if demand > max(capacities):
+                conflicts.append({
+                    "kind": "capacity",
+                    "constraints": [],
+                    "reason": f"{names[i]} needs {demand} units, more than any vehicle carries ({max(capacities)}).",
+                })
+    return conflicts
+
+
+def relaxable_constraints(data):
+    """Ids of the constraints the relaxation may drop: stop windows, precedence pairs, depot windows."""
+    from vrptw import HORIZON, vehicle_starts_ends
+
+    starts, ends = vehicle_starts_ends(data)
+    endpoints = set(starts) | set(ends)
+    constraints = [
+        f"window:{i}" for i, window in enumerate(data["time_windows"])
+        if i not in endpoints and tuple(window) != (0, HORIZON)
+    ]
+    constraints += [f"precedence:{k}" for k in range(len(data.get("precedence_constraints", [])))]
+    return constraints + ["depot_departure", "depot_return"]
+
+
+def relax(data, constraints):
+    """Copy of data with the given constraint ids removed; relaxed windows span the whole time dimension."""
+    from vrptw import HORIZON
+
+    relaxed = copy.deepcopy(data)
+    dropped_pairs = set()
+    for constraint in constraints:
+        kind, _, ref = constraint.partition(":")
+        if kind == "window":
+            relaxed["time_windows"][int(ref)] = [0, HORIZON]
+        elif kind == "precedence":
+            dropped_pairs.add(int(ref))
+        elif kind == "depot_departure":
+            relaxed["depot_departure_window"] = [0, HORIZON]
+        elif kind == "depot_return":
+            relaxed["depot_return_window"] = [0, HORIZON]
+    relaxed["precedence_constraints"] = [
+        pair for k, pair in enumerate(data.get("precedence_constraints", [])) if k not in dropped_pairs
+    ]
+    return relaxed
+
+
+def _solve_once(data):
+    """
+    One quick first-solution search: True if it found a route, False if it failed without one,
+    None if it ran out of time first (feasibility unknown).
+    """
+    from vrptw import build_routing_model
+
+    _, routing = build_routing_model(data)
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
+    params.solution_limit = 1
+    params.time_limit.FromMilliseconds(CHECK_TIME_LIMIT_MS)
+    if routing.SolveWithParameters(params) is not None:
+        return True
+    return False if routing.status() in NO_ROUTE_STATUSES else None
+
+
+def minimal_conflict(data, conflicts=None, max_checks=MAX_RELAXATION_CHECKS):
+    """
+    Deletion filter over the relaxable constraints: drops each constraint in turn and keeps it
+    dropped while the rest stay infeasible. What remains is a minimal set of constraints that
+    cannot all hold together (None if no route is found even with all of them relaxed, i.e. a
+    structural problem such as capacity or an unroutable stop, or a search that keeps timing out).
+    A check that times out is not proof of infeasibility, so its constraint stays in the conflict.
+    When the constraints named by check_constraints `conflicts` already account for the failure (or the
+    check cannot tell in time), the filter only runs over those, which usually takes a handful of solves.
+    """
+    candidates = relaxable_constraints(data)
+    suspects = [c for c in candidates if any(c in conflict["constraints"] for conflict in conflicts or [])]
+    # the suspects are proven to conflict, so only a check showing they are not the whole story widens the search
+    if suspects and _solve_once(relax(data, suspects)) is not False:
+        candidates = suspects
+    elif not _solve_once(relax(data, candidates)):
+        return None
+
+    conflict = list(candidates)
+    for checks, constraint in enumerate(candidates):
+        if checks >= max_checks:
+            break
+        trial = [c for c in conflict if c != constraint]
+        # still infeasible without it, so it is not needed to explain the failure
+        if _solve_once(relax(data, [c for c in candidates if c not in trial])) is False:
+            conflict = trial
+    return conflict
+
+
+def describe_constraint(data, constraint):
+    names = data["location_names"]
+    kind, _, ref = constraint.partition(":")
+    if kind == "window":
+        open_time, close_time = data["time_windows"][int(ref)]
+        return f"{names[int(ref)]} open {minutes_to_clock(open_time)}–{minutes_to_clock(close_time)}"
+    if kind == "precedence":
+        before, after = data["precedence_constraints"][int(ref)]
+        return f"{before} before {after}"
+    if kind == "depot_departure":
+        open_time, close_time = data["depot_departure_window"]
+        return f"leave between {minutes_to_clock(open_time)} and {minutes_to_clock(close_time)}"
+    open_time, close_time = data["depot_return_window"]
+    return f"return between {minutes_to_clock(open_time)} and {minutes_to_clock(close_time)}"
+
+
+def relaxed_route(data, conflict, penalty=RELAXED_PENALTY):
+    """
+    Best route once the conflicting constraints are softened: each dropped window or depot
+    window costs `penalty` per minute it is missed, so the route misses them as little as it can.
+    Returns the visit orders and how far each softened constraint is missed, None if no route is found.
+    """
+    from vrptw import build_routing_model, extract_visit_orders, vehicle_starts_ends
+
+    manager, routing = build_routing_model(relax(data, conflict))
+    time_dim = routing.GetDimensionOrDie("Time")
+    starts, ends = vehicle_starts_ends(data)
+    soft = {}
+    for constraint in conflict:
+        kind, _, ref = constraint.partition(":")
+        if kind == "window":
+            soft[constraint] = ([manager.NodeToIndex(int(ref))], data["time_windows"][int(ref)])
+        elif kind == "depot_departure":
+            soft[constraint] = ([routing.Start(v) for v in range(routing.vehicles())], data["depot_departure_window"])
+        elif kind == "depot_return":
+            returns = [routing.End(v) for v in range(routing.vehicles()) if ends[v] in starts]
+            soft[constraint] = (returns, data["depot_return_window"])
+    for indices, (open_time, close_time) in soft.values():
+        for index in indices:
+            time_dim.SetCumulVarSoftLowerBound(index, open_time, penalty)
+            time_dim.SetCumulVarSoftUpperBound(index, close_time, penalty)
+
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
+    params.time_limit.FromMilliseconds(RELAXED_TIME_LIMIT_MS)
+    solution = routing.SolveWithParameters(params)
+    if solution is None:
+        return None
+
+    violations = []
+    for constraint, (indices, (open_time, close_time)) in soft.items():
+        for index in indices:
+            if not routing.IsEnd(index) and not routing.IsStart(index) and not solution.Value(routing.ActiveVar(index)):
+                continue
+            arrival = solution.Value(time_dim.CumulVar(index))
+            label = describe_constraint(data, constraint)
+            if arrival > close_time:
+                violations.append(f"{label}: reached at {minutes_to_clock(arrival)}, {arrival - close_time} min late")
+            elif arrival < open_time:
+                violations.append(f"{label}: reached at {minutes_to_clock(arrival)}, {open_time - arrival} min early")
+    return {"visit_orders": extract_visit_orders(manager, routing, solution), "violations": violations}
+
+
+def diagnose_infeasibility(data, relax_constraints=True):
+    """
+    Explains why solve_vrptw found no route, without an LLM.
+    Returns {"reasons": [...], "conflicts": [...], "minimal_conflict": [...], "relaxed_route": ...}.
+    The solver-free checks run first; when `relax_constraints` is set, iterative relaxation then
+    finds a minimal conflicting set of constraints and the best route without them.
+    """
+    conflicts = check_constraints(data)
+    reasons = [conflict["reason"] for conflict in conflicts]
+    diagnosis = {"reasons": reasons, "conflicts": conflicts, "minimal_conflict": None, "relaxed_route": None}
+
+    structural = any(not conflict["constraints"] for conflict in conflicts)
+    if relax_constraints and not structural:
+        conflict = minimal_conflict(data, conflicts)
+        if conflict:
+            described = [describe_constraint(data, constraint) for constraint in conflict]
+            diagnosis["minimal_conflict"] = conflict
+            diagnosis["relaxed_route"] = relaxed_route(data, conflict)
+            if not reasons:
+                reasons.append(f"These constraints cannot all be met together: {'; '.join(described)}.")
+    if not reasons:
+        reasons.append(
+            "No conflicting constraints were found; the search may have stopped too early. "
+            "Try the quality search profile."
+        )
+    return diagnosis
+
+
+def explain_infeasibility(diagnosis):
+    """Plain-text explanation of a diagnosis, in the style of the other route texts."""
+    text = "No route satisfies every constraint.\n" + "\n".join(f"- {reason}" for reason in diagnosis["reasons"])
+    route = diagnosis.get("relaxed_route")
+    if route and route["violations"]:
+        text += "\n\nThe closest possible route misses:\n" + "\n".join(f"- {v}" for v in route["violations"])
+    return text
@@ -1,10 +1,18 @@
 from dotenv import load_dotenv
 import os
-import openai
+import re
 import json
+import hashlib
+from cache import SqliteCache
+from tracing import incr, logger
+from clients import get_openai_client
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# parsed instructions, keyed on the normalized instruction text and the system prompt
+PARSE_CACHE_TTL = int(os.getenv("PARSE_CACHE_TTL", 7 * 24 * 3600))
+PARSE_CACHE_MAX_ENTRIES = int(os.getenv("PARSE_CACHE_MAX_ENTRIES", 5000))
+parse_cache = SqliteCache("instructions", ttl=PARSE_CACHE_TTL, max_entries=PARSE_CACHE_MAX_ENTRIES)
 
 SYSTEM_PROMPT = """
 You are an assistant that helps plan optimal driving routes for users.  
@@ -25,7 +33,15 @@ Your output must be a **pure JSON object** with these fields:
 - depot_return_window: pair (earliest_return_time, latest_return_time), in minutes from midnight
 - custom_end_index: optional integer → if specified, this index is the final stop and the route should end there instead of returning to the depot
 - precedence_constraints: list of pairs of strings  
-- num_vehicles: always set to 1
+- num_vehicles: number of drivers → 1 unless the user explicitly mentions several drivers or vehicles
+
+**Optional fields for several drivers** (only include them when num_vehicles > 1 and the user gives the details):
+- vehicle_starts / vehicle_ends: list of integers, one per driver → index of the location each driver starts / ends at
+- vehicle_shifts: list of pairs (shift_start, shift_end), one per driver, in minutes from midnight
+- vehicle_capacities: list of integers, one per driver, with location_demands: list of integers, one per location (0 for depots)
+
+**Optional stop priorities** (only include when the user says some stops are optional or especially important):
+- location_priorities: list of integers, one per location → 1 = optional ("if there's time"), 2 = normal, 3 = important (2 for depots)
 
 **Additional behavior for vague phrases**:
 
@@ -50,8 +66,289 @@ If the user uses vague language, infer values as follows:
 Only return valid JSON. No markdown or extra text.
 """
 
-def get_data(user_instruction):
-    response = openai.chat.completions.create(
+def normalize_instruction(user_instruction):
+    """Collapse whitespace so resubmissions that only differ in spacing share a cache entry."""
+    lines = (" ".join(line.split()) for line in user_instruction.strip().splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def instruction_cache_key(user_instruction):
+    prompt_hash = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+    text = normalize_instruction(user_instruction)
+    return hashlib.sha256(f"{prompt_hash}\n{text}".encode("utf-8")).hexdigest()
+
+
+def validate_data(data):
+    """
+    Checks that a parsed data dict is solver-ready.
+    Raises ValueError listing every problem found.
+    """
+    errors = []
+    required = ["location_addresses", "location_names", "location_durations", "time_windows", "depot", "num_vehicles"]
+    missing = [key for key in required if key not in data]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+
+    n = len(data["location_addresses"])
+    if n < 2:
+        errors.append("At least an origin and one stop are required")
+    for key in ["location_names", "location_durations", "time_windows"]:
+        if len(data[key]) != n:
+            errors.append(f"{key} has {len(data[key])} entries, expected {n}")
+
+    def is_window(window):
+        return (
+            isinstance(window, (list, tuple)) and len(window) == 2
+            and all(isinstance(t, int) for t in window) and window[0] <= window[1]
+        )
+
+    for i, window in enumerate(data["time_windows"]):
+        if not is_window(window):
+            errors.append(f"time_windows[{i}] is not a valid (open, close) pair: {window}")
+    for i, duration in enumerate(data["location_durations"]):
+        if not isinstance(duration, int) or duration < 0:
+            errors.append(f"location_durations[{i}] is not a non-negative integer: {duration}")
+
+    if "depot_departure_window" not in data and "depot_time_window" not in data:
+        errors.append("Missing depot_departure_window")
+    for key in ["depot_departure_window", "depot_return_window", "depot_time_window"]:
+        if key in data and not is_window(data[key]):
+            errors.append(f"{key} is not a valid (open, close) pair: {data[key]}")
+    if not isinstance(data["depot"], int) or not 0 <= data["depot"] < n:
+        errors.append(f"Invalid depot index: {data['depot']}")
+    if "custom_end_index" in data and not (
+        isinstance(data["custom_end_index"], int) and 0 <= data["custom_end_index"] < n
+    ):
+        errors.append(f"Invalid custom_end_index: {data['custom_end_index']}")
+    if not isinstance(data["num_vehicles"], int) or data["num_vehicles"] < 1:
+        errors.append(f"Invalid num_vehicles: {data['num_vehicles']}")
+    num_vehicles = data["num_vehicles"]
+    for key in ["vehicle_starts", "vehicle_ends"]:
+        if key in data and (
+            len(data[key]) != num_vehicles
+            or not all(isinstance(node, int) and 0 <= node < n for node in data[key])
+        ):
+            errors.append(f"{key} must list one valid location index per vehicle: {data[key]}")
+    if "vehicle_shifts" in data and (
+        len(data["vehicle_shifts"]) != num_vehicles or not all(is_window(shift) for shift in data["vehicle_shifts"])
+    ):
+        errors.append(f"vehicle_shifts must list one (start, end) pair per vehicle: {data['vehicle_shifts']}")
+    if "vehicle_capacities" in data:
+        if len(data["vehicle_capacities"]) != num_vehicles:
+            errors.append(f"vehicle_capacities has {len(data['vehicle_capacities'])} entries, expected {num_vehicles}")
+        if len(data.get("location_demands", [])) != n:
+            errors.append("location_demands must list one demand per location when vehicle_capacities is set")
+
+    if "location_priorities" in data and (
+        len(data["location_priorities"]) != n or any(p not in (1, 2, 3) for p in data["location_priorities"])
+    ):
+        errors.append(f"location_priorities must list 1, 2 or 3 per location: {data['location_priorities']}")
+
+    for pair in data.get("precedence_constraints", []):
+        if len(pair) != 2 or any(name not in data["location_names"] for name in pair):
+            errors.append(f"Precedence constraint references unknown stops: {pair}")
+
+    if errors:
+        raise ValueError("; ".join(errors))
+
+
+# Rule-based fast path for instructions shaped like user_instruction_scenarios.txt
+PLACE_RE = re.compile(r"\(([^()]+)\)")
+NAME_MARKER_RE = re.compile(r"\b(?:at|from|to|visit)\s+", re.I)
+CLOCK = r"(\d{1,2}:\d{2}\s*(?:[ap]\.?m\.?)?|\d{3,4}\s*hrs)"
+WINDOW_RE = re.compile(rf"\b(?:from|between)\s+{CLOCK}\s+(?:to|and|until|-)\s+{CLOCK}", re.I)
+EXACT_RE = re.compile(rf"\bexactly\s+at\s+{CLOCK}", re.I)
+AFTER_RE = re.compile(rf"\bafter\s+{CLOCK}", re.I)
+BEFORE_RE = re.compile(rf"\b(?:before|by)\s+{CLOCK}", re.I)
+AT_RE = re.compile(rf"\bat\s+{CLOCK}", re.I)
+DURATION_RE = re.compile(r"\b(\d+(?:\.\d+)?)[\s-]*(minute|min|hour)s?\b", re.I)
+# phrases whose meaning the rules do not capture (ordering, vague times and durations)
+VAGUE_RE = re.compile(
+    r"\b(?:then|after that|afterwards|before that|later|while|morning|afternoon|evening|lunch\w*|"
+    r"night|noon|around|about|some time|a few|quick|drop by|roughly|approximately|unless|or)\b",
+    re.I,
+)
+
+
+def _parse_clock(text):
+    """'1736 hrs', '0930hrs', '10:00 AM' -> minutes from midnight."""
+    text = text.strip().lower().replace(".", "")
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})\s*([ap]m)?", text)
+    if match:
+        hours, minutes, meridiem = int(match.group(1)), int(match.group(2)), match.group(3)
+        if meridiem == "pm" and hours != 12:
+            hours += 12
+        elif meridiem == "am" and hours == 12:
+            hours = 0
+    else:
+        digits = re.match(r"\d+", text).group()
+        hours, minutes = int(digits[:-2]), int(digits[-2:])
+    if hours > 23 or minutes > 59:
+        raise ValueError(f"Invalid time: {text}")
+    return hours * 60 + minutes
+
+
+def _parse_window(text):
+    """Arrival window from the time phrases in a line, None when it has none."""
+    match = WINDOW_RE.search(text)
+    if match:
+        return [_parse_clock(match.group(1)), _parse_clock(match.group(2))]
+    match = EXACT_RE.search(text)
+    if match:
+        t = _parse_clock(match.group(1))
+        return [t, t]
+    match = AFTER_RE.search(text)
+    if match:
+        return [_parse_clock(match.group(1)), 1439]
+    match = BEFORE_RE.search(text)
+    if match:
+        return [0, _parse_clock(match.group(1))]
+    match = AT_RE.search(text)
+    if match:
+        t = _parse_clock(match.group(1))
+        return [t, t]
+    return None
+
+
+def _parse_duration(text):
+    match = DURATION_RE.search(text)
+    if not match:
+        return None
+    value = float(match.group(1))
+    return int(round(value * 60 if match.group(2).lower() == "hour" else value))
+
+
+def _split_places(line):
+    """[(name, address, trailing text)] for every 'Name (address)' in a line."""
+    matches = list(PLACE_RE.finditer(line))
+    places = []
+    for k, match in enumerate(matches):
+        prefix = line[matches[k - 1].end() if k else 0:match.start()]
+        name = NAME_MARKER_RE.split(prefix)[-1].strip(" ,.")
+        if not name or len(NAME_MARKER_RE.split(prefix)) < 2:
+            return None
+        rest = line[match.end():matches[k + 1].start() if k + 1 < len(matches) else len(line)]
+        places.append((name, match.group(1).strip(), rest))
+    return places
+
+
+def parse_structured_instruction(user_instruction):
+    """
+    Deterministically parses instructions written as one bullet per stop, e.g.
+    "Stop at CVS (119 E Lancaster Ave, Ardmore, PA) for 10 minutes. It's open from 0900 hrs to 2100 hrs."
+    Returns the same data dict as get_data, or None when any line is not confidently understood.
+    """
+    names, addresses, durations, windows = [], [], [], []
+    departure_window = None
+    return_window = None
+    end_index = None
+
+    for raw_line in user_instruction.strip().splitlines():
+        line = raw_line.strip()
+        if not line or (line.endswith(":") and "(" not in line):
+            continue
+        if not line.startswith(("-", "*", "•")):
+            return None
+        line = line.lstrip("-*• ").strip()
+        if VAGUE_RE.search(line):
+            return None
+        places = _split_places(line)
+        if places is None:
+            return None
+        lowered = line.lower()
+
+        try:
+            if re.match(r"(?:i want to |i will |i'll )?leave\b", lowered):
+                if departure_window is not None or not places:
+                    return None
+                name, address, rest = places[0]
+                names.append(name)
+                addresses.append(address)
+                durations.append(0)
+                windows.append([0, 1439])
+                departure_window = _parse_window(rest) or [0, 1439]
+                places = places[1:]
+            elif re.match(r"return (?:home|to (?:the )?(?:origin|start))\b", lowered) and not places:
+                if return_window is not None:
+                    return None
+                return_window = _parse_window(line) or [0, 1439]
+                continue
+            elif re.match(r"end (?:the|my) (?:trip|day)\b", lowered) and len(places) == 1:
+                if end_index is not None:
+                    return None
+                name, address, rest = places[0]
+                end_index = len(names)
+                names.append(name)
+                addresses.append(address)
+                durations.append(_parse_duration(rest) or 0)
+                windows.append(_parse_window(rest) or [0, 1439])
+                continue
+
+            if departure_window is None:
+                return None
+            for name, address, rest in places:
+                duration = _parse_duration(rest)
+                if duration is None:
+                    return None
+                names.append(name)
+                addresses.append(address)
+                durations.append(duration)
+                windows.append(_parse_window(rest) or [0, 1439])
+        except ValueError:
+            return None
+
+    if departure_window is None or len(names) < 2 or (end_index is None) == (return_window is None):
+        return None
+
+    data = {
+        "location_addresses": addresses,
+        "location_names": names,
+        "location_durations": durations,
+        "time_windows": windows,
+        "depot": 0,
+        "depot_departure_window": departure_window,
+        "depot_return_window": return_window or [0, 1439],
+        "precedence_constraints": [],
+        "num_vehicles": 1,
+    }
+    if end_index is not None:
+        data["custom_end_index"] = end_index
+
+    try:
+        validate_data(data)
+    except ValueError:
+        return None
+    return data
+
+
+def get_data(user_instruction, use_cache=True, validate=True, use_rules=True):
+    """
+    Parses a natural language instruction into routing data with gpt-4o.
+    Structured instructions are handled by parse_structured_instruction without the LLM.
+    Repeat instructions are served from the parse cache; only entries that pass
+    validate_data are cached when `validate` is set.
+    """
+    if use_rules:
+        data = parse_structured_instruction(user_instruction)
+        if data is not None:
+            incr("parse.rules")
+            return data
+
+    key = instruction_cache_key(user_instruction)
+    if use_cache:
+        data = parse_cache.get(key)
+        if data is not None:
+            try:
+                if validate:
+                    validate_data(data)
+                incr("parse_cache.hits")
+                return data
+            except ValueError as e:
+                logger.warning("Cached instruction failed validation, re-parsing: %s", e)
+
+    incr("parse_cache.misses")
+    incr("api.openai")
+    response = get_openai_client().chat.completions.create(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -78,6 +375,16 @@ def get_data(user_instruction):
     if "custom_end_index" in data:
         assert 0 <= data["custom_end_index"] < len(data["location_names"]), "Invalid custom_end_index"
 
+    cacheable = use_cache
+    if validate:
+        try:
+            validate_data(data)
+        except ValueError as e:
+            logger.warning("Parsed data failed validation, not caching: %s", e)
+            cacheable = False
+    if cacheable:
+        parse_cache.set(key, data)
+
     return data
 
 def print_data(data):
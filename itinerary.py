@@ -0,0 +1,96 @@
+def clock_to_minutes(clock):
+    """'H:MM' (as stored in arrival_departure_info) to minutes since midnight."""
+    hours, minutes = clock.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def minutes_to_clock(minutes):
+    return f"{minutes // 60}:{minutes % 60:02d}"
+
+
+def format_duration(minutes):
+    """Travel/journey time in words, e.g. '1 hour and 5 minutes' or '25 minutes'."""
+    hours, minutes = divmod(int(minutes), 60)
+    hour_text = f"{hours} hour{'s' if hours != 1 else ''}"
+    minute_text = f"{minutes} minute{'s' if minutes != 1 else ''}"
+    if hours and minutes:
+        return f"{hour_text} and {minute_text}"
+    return hour_text if hours else minute_text
+
+
+def render_vehicle_itinerary(data, stops):
+    """Itinerary for one vehicle; `stops` is its (node, arrival, departure) list from extract_route_text."""
+    late = {stop["index"]: stop for stop in data.get("bent_constraints", {}).get("late", [])}
+    names = data["location_names"]
+    addresses = data["location_addresses"]
+    durations = data["location_durations"]
+    time_matrix = data["time_matrix"]
+
+    start, _, start_departure = stops[0]
+    lines = [f"Departure from origin, {addresses[start]}, at {start_departure}.", ""]
+    departure = clock_to_minutes(start_departure)
+    previous = start
+
+    for position, (node, arrival_clock, departure_clock) in enumerate(stops[1:], start=1):
+        travel_time = time_matrix[previous][node]
+        arrival = clock_to_minutes(arrival_clock)
+        is_last = position == len(stops) - 1
+
+        if is_last and node == start:
+            lines.append(
+                f"Travel back to origin, {addresses[node]}. Travel time is {format_duration(travel_time)}. "
+                f"You will arrive back at your origin at {arrival_clock}. "
+                f"Your total journey was {format_duration(arrival - clock_to_minutes(start_departure))}."
+            )
+            break
+
+        lines.append(
+            f"Travel to {names[node]}, {addresses[node]}. Travel time is {format_duration(travel_time)}. "
+            f"You will arrive at {names[node]} at {minutes_to_clock(min(arrival, departure + travel_time))}."
+        )
+        if arrival > departure + travel_time:
+            lines.append(f"Wait until {arrival_clock} for {names[node]} to open.")
+        if node in late:
+            lines.append(f"This is {format_duration(late[node]['minutes_late'])} after {names[node]} closes "
+                         f"at {late[node]['closes']}.")
+        if is_last:
+            lines.append(
+                f"Your trip ends at {names[node]}. "
+                f"Your total journey was {format_duration(arrival - clock_to_minutes(start_departure))}."
+            )
+            break
+        lines.append(
+            f"Stay at {names[node]} for {durations[node]} minutes from {arrival_clock} to {departure_clock}."
+        )
+        lines.append(f"Departure from {names[node]} at {departure_clock}.")
+        lines.append("")
+
+        departure = clock_to_minutes(departure_clock)
+        previous = node
+
+    return "\n".join(lines)
+
+
+def render_itinerary(data):
+    """
+    Plain-text itinerary for a solved route, built locally from the schedule stored by extract_route_text:
+    departure, travel time, arrival, stay window per stop, then the return leg and total journey.
+    Fleets get one section per driver. Late arrivals and dropped stops from a soft solve are called out.
+    """
+    vehicle_stops = [stops for stops in data["vehicle_arrival_departure_info"] if stops]
+    if not vehicle_stops:
+        # every route goes straight from its start to its end, e.g. a soft solve that dropped every stop
+        text = "No stops are scheduled for this day."
+    elif data["num_vehicles"] == 1:
+        text = render_vehicle_itinerary(data, vehicle_stops[0])
+    else:
+        sections = []
+        for vehicle_id, stops in enumerate(data["vehicle_arrival_departure_info"]):
+            if stops:
+                sections.append(f"Driver {vehicle_id}:\n\n" + render_vehicle_itinerary(data, stops))
+        text = "\n\n".join(sections)
+
+    dropped = data.get("bent_constraints", {}).get("dropped", [])
+    if dropped:
+        text += "\n\nCould not fit into the day: " + ", ".join(stop["name"] for stop in dropped) + "."
+    return text
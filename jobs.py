@@ -0,0 +1,166 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 32))
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 120))
+# finished jobs are kept this long so clients can poll them and duplicates reuse them
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 600))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _call(func, kwargs, conn):
+    """Job process entry point: sends back (True, result) or (False, exception)."""
+    try:
+        conn.send((True, func(**kwargs)))
+    except Exception as e:
+        try:
+            conn.send((False, e))
+        except Exception:
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
+    finally:
+        conn.close()
+
+
+class Job:
+    def __init__(self, job_id, key, future, timeout=JOB_TIMEOUT):
+        self.id = job_id
+        self.key = key
+        self.future = future
+        self.timeout = timeout
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.timed_out = False
+
+    @property
+    def state(self):
+        if self.timed_out:
+            return "timeout"
+        if self.future.cancelled():
+            return "cancelled"
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        if isinstance(self.future.exception(), JobTimeout):
+            return "timeout"
+        return "failed" if self.future.exception() is not None else "done"
+
+    def to_dict(self):
+        payload = {
+            "job_id": self.id,
+            "status": self.state,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+        }
+        if payload["status"] == "done":
+            payload["result"] = self.future.result()
+        elif payload["status"] == "failed":
+            payload["error"] = str(self.future.exception())
+        elif payload["status"] == "timeout":
+            payload["error"] = f"Job did not finish within {self.timeout} seconds"
+        return payload
+
+
+class JobQueue:
+    """
+    Bounded queue for long-running solves, each run in its own process.
+    Identical submissions share one job while it is pending or its result is fresh, at most
+    `max_pending` jobs wait at a time and `max_workers` run at once. A job still unfinished
+    `timeout` seconds after submission is reported as timed out and its process is terminated,
+    so a stuck solve frees its slot instead of holding it. `on_result` is called in this process
+    with each successful result.
+    """
+
+    def __init__(self, func, max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, timeout=JOB_TIMEOUT,
+                 on_result=None):
+        self.func = func
+        self.on_result = on_result
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # one thread per running job, each supervising that job's process
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        return self._executor
+
+    def _run(self, kwargs, deadline):
+        """Runs func(**kwargs) in a fresh process, terminating it if it is still running at `deadline`."""
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_call, args=(self.func, kwargs, sender), daemon=True)
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(max(0, deadline - time.time())):
+                process.terminate()
+                raise JobTimeout(f"Job did not finish within {self.timeout} seconds")
+            ok, value = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f"Job process exited with code {process.exitcode}") from None
+        finally:
+            receiver.close()
+            process.join()
+        if not ok:
+            raise value
+        return value
+
+    def submit(self, **kwargs):
+        """Queues func(**kwargs) and returns its Job, reusing an identical pending or recent job."""
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True).encode("utf-8")).hexdigest()
+        with self._lock:
+            self._expire()
+            existing = self._by_key.get(key)
+            if existing is not None and existing.state in ("queued", "running", "done"):
+                return existing
+
+            pending = sum(1 for job in self._jobs.values() if job.state in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} jobs already pending")
+
+            future = self._pool().submit(self._run, kwargs, time.time() + self.timeout)
+            job = Job(uuid.uuid4().hex, key, future, self.timeout)
+            job.future.add_done_callback(lambda _: self._finished(job))
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            return job
+
+    def _finished(self, job):
+        job.finished_at = job.finished_at or time.time()
+        if self.on_result is not None and job.state == "done":
+            self.on_result(job.future.result())
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.state in ("queued", "running") and now - job.submitted_at > self.timeout:
+                job.timed_out = True
+                job.future.cancel()
+                job.finished_at = now
+            if job.finished_at is not None and now - job.finished_at > JOB_RESULT_TTL:
+                del self._jobs[job_id]
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
@@ -1,69 +1,545 @@
-import googlemaps
+import polyline
+import requests
+import numpy as np
 from dotenv import load_dotenv
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from cache import SqliteCache, normalize_address
+from tracing import incr, logger, traced
 
 load_dotenv()
-GOOGLEMAPS_API_KEY = os.getenv("GOOGLEMAPS_API_KEY")
-gmaps = googlemaps.Client(key = GOOGLEMAPS_API_KEY)
 
+# pair-level travel cache: one entry per (mode, origin, destination)
+TRAVEL_CACHE_TTL = int(os.getenv("TRAVEL_CACHE_TTL", 7 * 24 * 3600))
+TRAVEL_CACHE_MAX_ENTRIES = int(os.getenv("TRAVEL_CACHE_MAX_ENTRIES", 200000))
+# cached in place of a pair Google could not route (element status NOT_FOUND, ZERO_RESULTS, ...)
+UNROUTABLE_PAIR = {"unroutable": True}
+travel_cache = SqliteCache("travel", ttl=TRAVEL_CACHE_TTL, max_entries=TRAVEL_CACHE_MAX_ENTRIES)
+
+# Distance Matrix per-request limits
+MAX_MATRIX_ORIGINS = 25
+MAX_MATRIX_DESTINATIONS = 25
+MAX_MATRIX_ELEMENTS = 100
+# origins missing different destinations may share tiles if that fetches at most this many times the pairs they need
+MAX_TILE_OVERFETCH = float(os.getenv("MAX_TILE_OVERFETCH", 2))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 8))
+
+# directions cache: one encoded polyline per (mode, origin, destination) leg
+DIRECTIONS_CACHE_TTL = int(os.getenv("DIRECTIONS_CACHE_TTL", 30 * 24 * 3600))
+DIRECTIONS_CACHE_MAX_ENTRIES = int(os.getenv("DIRECTIONS_CACHE_MAX_ENTRIES", 50000))
+directions_cache = SqliteCache("directions", ttl=DIRECTIONS_CACHE_TTL, max_entries=DIRECTIONS_CACHE_MAX_ENTRIES)
+MAX_DIRECTIONS_WAYPOINTS = 25
+
+# offline estimates: great-circle distance stretched by a road factor, at an average speed
+ROAD_FACTOR = float(os.getenv("ROAD_FACTOR", 1.3))
+AVERAGE_SPEED_KMH = float(os.getenv("AVERAGE_SPEED_KMH", 40))
+# osrm-routed listens on 5000 by default, which is the Flask API's port, so run it on 5001
+OSRM_URL = os.getenv("OSRM_URL", "http://localhost:5001")
+DEFAULT_MATRIX_PROVIDER = os.getenv("MATRIX_PROVIDER", "google")
+# offline estimates: how much slower than AVERAGE_SPEED_KMH traffic is in each hour of the day
+RUSH_HOUR_FACTORS = {7: 1.25, 8: 1.4, 9: 1.2, 16: 1.2, 17: 1.4, 18: 1.25}
+# hour buckets are departures on a weekday in the plan's local time
+ROUTE_TIMEZONE = os.getenv("ROUTE_TIMEZONE", "America/New_York")
+# sparse matrices: Google is asked only for each stop's nearest neighbours,
+# the other pairs are estimated or forbidden
+MATRIX_NEIGHBORS = int(os.getenv("MATRIX_NEIGHBORS", 10))
+SPARSE_FILL = os.getenv("SPARSE_FILL", "estimate")
+SPARSE_FILLS = ("estimate", "forbid")
+# travel time and distance of a pair that cannot be driven
+UNREACHABLE_MINUTES = 99999
+UNREACHABLE_KM = 9999
+
+
+# geocode cache: normalized address -> [lat, lng]
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", 90 * 24 * 3600))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", 50000))
+geocode_cache = SqliteCache("geocode", ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_MAX_ENTRIES)
+
+
+def _geocode(address, gmaps_client):
+    geocode_res = gmaps_client.geocode(address)
+    if geocode_res:
+        location = geocode_res[0]['geometry']['location']
+        return (location['lat'], location['lng'])
+    logger.warning("No geocode result for address: %s", address)
+    return None
+
+
+@traced("geocode")
+def geocode_addresses(address_list, gmaps_client, cache=geocode_cache):
+    """
+    Returns a (lat, lng) tuple per address, (None, None) when an address cannot be geocoded.
+    Cached addresses are not requested again; the rest are geocoded concurrently.
+    """
+    keys = [normalize_address(address) for address in address_list]
+    cached = cache.get_many(keys) if cache else {}
+
+    # geocode each distinct uncached address once
+    missing = {key: address for key, address in zip(keys, address_list) if key not in cached}
+    incr("geocode_cache.hits", len(keys) - len(missing))
+    incr("geocode_cache.misses", len(missing))
+    incr("api.geocode", len(missing))
+    fetched = {}
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(missing))) as pool:
+            results = pool.map(lambda address: _geocode(address, gmaps_client), missing.values())
+            fetched = dict(zip(missing, results))
+        if cache:
+            cache.set_many({key: list(lat_lng) for key, lat_lng in fetched.items() if lat_lng is not None})
 
-def geocode_addresses(address_list, gmaps_client):
     coords = []
-    for address in address_list:
-        geocode_res = gmaps_client.geocode(address)
-        if geocode_res:
-            location = geocode_res[0]['geometry']['location']
-            lat_lng = (location['lat'], location['lng'])
-            coords.append(lat_lng)
-        else:
-            print(f"Warning: No geocode result for address: {address}")
-            coords.append((None, None))  # fallback
+    for key in keys:
+        lat_lng = cached.get(key) or fetched.get(key)
+        coords.append(tuple(lat_lng) if lat_lng else (None, None))  # fallback
     return coords
 
-# construct time matrix
-def get_time_matrix(address_list, gmaps_client):
-    matrix = gmaps_client.distance_matrix(
-        origins=address_list,
-        destinations=address_list,
-        mode='driving'
+
+def _pair_key(origin, destination, mode, hour=None):
+    # hour-bucketed travel times are cached separately from the static ones
+    mode = mode if hour is None else f"{mode}@{hour:02d}"
+    return f"{mode}|{normalize_address(origin)}|{normalize_address(destination)}"
+
+
+def next_departure(hour, now=None):
+    """
+    The next weekday the clock reads hour:00 in ROUTE_TIMEZONE, used as the departure_time of an hour bucket.
+    Buckets are cached by hour alone, so they always describe typical weekday traffic in the plan's local time.
+    """
+    timezone = ZoneInfo(ROUTE_TIMEZONE)
+    now = now.astimezone(timezone) if now else datetime.now(timezone)
+    departure = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    while departure <= now or departure.weekday() >= 5:
+        departure += timedelta(days=1)
+    return departure
+
+
+def _tile(origins, dests):
+    """Split an origins x destinations block into tiles within the per-request limits."""
+    def shape(dest_step):
+        origin_step = min(MAX_MATRIX_ORIGINS, MAX_MATRIX_ELEMENTS // dest_step, len(origins))
+        return -(-len(origins) // origin_step) * -(-len(dests) // dest_step), origin_step
+
+    # pick the tile shape that needs the fewest requests
+    dest_step = min(range(1, min(len(dests), MAX_MATRIX_DESTINATIONS) + 1), key=lambda step: shape(step)[0])
+    origin_step = shape(dest_step)[1]
+    for o in range(0, len(origins), origin_step):
+        for d in range(0, len(dests), dest_step):
+            yield origins[o:o + origin_step], dests[d:d + dest_step]
+
+
+def _blocks(missing_by_origin):
+    """
+    Groups the missing pairs into (origins, destinations) blocks to tile. Origins missing the same
+    destinations share a block (a cold cache is one block); blocks whose destinations overlap are
+    merged while that saves requests, so sparse subsets do not cost a request per origin.
+    """
+    same = {}
+    for i, dests in missing_by_origin.items():
+        same.setdefault(tuple(dests), []).append(i)
+    blocks = [(origins, set(dests)) for dests, origins in same.items()]
+    block_of = {i: b for b, (origins, _) in enumerate(blocks) for i in origins}
+
+    def requests(origins, dests):
+        return sum(1 for _ in _tile(origins, list(dests)))
+
+    merged = []
+    unvisited = set(range(len(blocks)))
+    while unvisited:
+        b = min(unvisited)
+        unvisited.discard(b)
+        origins, dests = list(blocks[b][0]), set(blocks[b][1])
+        needed = len(origins) * len(dests)
+        while True:
+            # the next block is the unvisited one sharing the most destinations, among blocks
+            # whose origins are destinations of this one (neighbouring stops)
+            near = {block_of[j] for j in dests if j in block_of} & unvisited
+            if not near:
+                break
+            nxt = max(near, key=lambda c: (len(dests & blocks[c][1]), -c))
+            nxt_origins, nxt_dests = blocks[nxt]
+            union = dests | nxt_dests
+            if (requests(origins + nxt_origins, union) >= requests(origins, dests) + requests(nxt_origins, nxt_dests)
+                    or (len(origins) + len(nxt_origins)) * len(union)
+                    > MAX_TILE_OVERFETCH * (needed + len(nxt_origins) * len(nxt_dests))):
+                break
+            unvisited.discard(nxt)
+            origins += nxt_origins
+            dests = union
+            needed += len(nxt_origins) * len(nxt_dests)
+        merged.append((origins, sorted(dests)))
+    return merged
+
+
+def _fetch_tile(address_list, origins, dests, gmaps_client, mode, hour=None):
+    kwargs = {} if hour is None else {"departure_time": next_departure(hour)}
+    response = gmaps_client.distance_matrix(
+        origins=[address_list[i] for i in origins],
+        destinations=[address_list[j] for j in dests],
+        mode=mode,
+        **kwargs
     )
+    tile = {}
+    for row_i, i in enumerate(origins):
+        for col_j, j in enumerate(dests):
+            element = response['rows'][row_i]['elements'][col_j]
+            if element['status'] == 'OK':
+                # with a departure_time Google also predicts the duration in traffic
+                duration = element.get('duration_in_traffic', element['duration'])['value']
+                tile[(i, j)] = {"duration": duration, "distance": element['distance']['value']}
+            else:
+                logger.warning("Distance Matrix element [%s][%s] error: %s", i, j, element['status'])
+                tile[(i, j)] = None
+    return tile
+
+
+def get_travel_pairs(address_list, gmaps_client, mode='driving', cache=travel_cache, subset=None, hour=None):
+    """
+    Returns {(i, j): {"duration": seconds, "distance": meters}} for every origin/destination pair,
+    or only the (i, j) pairs in `subset`. With `hour`, durations are for departures at that hour of day.
+    Pairs already in the cache (routable or not) are not requested again; a pair is None if Google could not route it.
+    Missing pairs are grouped into shared tiles (see _blocks) within Google's element limits and fetched concurrently.
+    """
+    n = len(address_list)
+    wanted = subset if subset is not None else [(i, j) for i in range(n) for j in range(n)]
+    keys = {(i, j): _pair_key(address_list[i], address_list[j], mode, hour) for i, j in wanted}
+    cached = cache.get_many(keys.values()) if cache else {}
+
+    pairs = {}
+    missing_by_origin = {}
+    for (i, j), key in keys.items():
+        if key in cached:
+            pairs[(i, j)] = None if cached[key] == UNROUTABLE_PAIR else cached[key]
+        else:
+            missing_by_origin.setdefault(i, []).append(j)
+
+    tiles = [tile for origins, dests in _blocks(missing_by_origin) for tile in _tile(origins, dests)]
+
+    fetched = {}
+    if tiles:
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(tiles))) as pool:
+            results = pool.map(lambda t: _fetch_tile(address_list, t[0], t[1], gmaps_client, mode, hour), tiles)
+            for tile in results:
+                fetched.update(tile)
+    # shared tiles also fetch pairs outside the subset; those are cached but not returned
+    pairs.update((ij, pair) for ij, pair in fetched.items() if ij in keys)
+
+    if cache:
+        # unroutable pairs are cached too, so a warm request for the same stops makes no Google call
+        cache.set_many({
+            keys.get(ij) or _pair_key(address_list[ij[0]], address_list[ij[1]], mode, hour):
+                UNROUTABLE_PAIR if pair is None else pair
+            for ij, pair in fetched.items()
+        })
+    incr("travel_cache.hits", len(cached))
+    incr("travel_cache.misses", len(keys) - len(cached))
+    incr("api.distance_matrix", len(tiles))
+
+    return pairs
+
+
+def pair_time_distance(pair):
+    """(minutes, km) for a travel pair, with large fallback values when it could not be routed."""
+    if pair is None:
+        return UNREACHABLE_MINUTES, UNREACHABLE_KM  # large values for unreachable
+    return pair["duration"] // 60, pair["distance"] / 1000  # seconds → minutes, meters → km
+
+
+def get_travel_matrices(address_list, gmaps_client, mode='driving', cache=travel_cache, hour=None):
+    """
+    Builds the time matrix (minutes) and distance matrix (km) from a single set of
+    Distance Matrix responses, for departures at `hour` when given.
+    """
+    pairs = get_travel_pairs(address_list, gmaps_client, mode=mode, cache=cache, hour=hour)
+    n = len(address_list)
 
     time_matrix = []
-    for row in matrix['rows']:
+    distance_matrix = []
+    for i in range(n):
         time_row = []
-        for element in row['elements']:
-            if element['status'] == 'OK':
-                time_sec = element['duration']['value']
-                time_min = time_sec // 60
-                time_row.append(time_min)
-            else:
-                print("Warning: Distance Matrix element error:", element['status'])
-                time_row.append(99999)  # large value for unreachable
+        distance_row = []
+        for j in range(n):
+            travel_time, travel_dist = pair_time_distance(pairs[(i, j)])
+            time_row.append(travel_time)
+            distance_row.append(travel_dist)
         time_matrix.append(time_row)
+        distance_matrix.append(distance_row)
 
-    return time_matrix
+    return time_matrix, distance_matrix
 
 
-def get_distance_matrix(location_addresses, gmaps):
-    n = len(location_addresses)
-    distance_matrix = [[0] * n for _ in range(n)]
+# construct time matrix
+def get_time_matrix(address_list, gmaps_client, mode='driving', cache=travel_cache):
+    return get_travel_matrices(address_list, gmaps_client, mode=mode, cache=cache)[0]
 
-    for i in range(n):
-        origins = [location_addresses[i]]
-        destinations = location_addresses
 
-        response = gmaps.distance_matrix(origins, destinations, mode='driving')
+def get_distance_matrix(location_addresses, gmaps, mode='driving', cache=travel_cache):
+    return get_travel_matrices(location_addresses, gmaps, mode=mode, cache=cache)[1]
+
 
+def _fetch_leg(origin, destination, gmaps_client, mode):
+    directions = gmaps_client.directions(origin, destination, mode=mode)
+    if directions:
+        return directions[0]['overview_polyline']['points']
+    logger.warning("No directions from %s to %s", origin, destination)
+    return None
+
+
+def _fetch_route_legs(address_sequence, gmaps_client, mode):
+    """One directions request through every address in order; returns an encoded polyline per leg."""
+    directions = gmaps_client.directions(
+        address_sequence[0],
+        address_sequence[-1],
+        waypoints=address_sequence[1:-1],
+        mode=mode
+    )
+    if not directions:
+        logger.warning("No directions for multi-stop route")
+        return [None] * (len(address_sequence) - 1)
+    legs = []
+    for leg in directions[0]['legs']:
+        points = []
+        for step in leg['steps']:
+            points.extend(polyline.decode(step['polyline']['points']))
+        legs.append(polyline.encode(points))
+    return legs
+
+
+@traced("directions")
+def get_leg_polylines(legs, gmaps_client, mode='driving', cache=directions_cache, single_request=False):
+    """
+    Returns the decoded polyline (list of (lat, lng)) for each (origin, destination) leg, None if unroutable.
+    Cached legs are free; the rest are fetched concurrently, or, with `single_request` and consecutive
+    legs, in one multi-waypoint directions request.
+    """
+    keys = [_pair_key(origin, destination, mode) for origin, destination in legs]
+    cached = cache.get_many(keys) if cache else {}
+
+    # legs that start and end at the same place have no route to draw
+    stationary = {key for key, (origin, destination) in zip(keys, legs)
+                  if normalize_address(origin) == normalize_address(destination)}
+    missing = {key: leg for key, leg in zip(keys, legs) if key not in cached and key not in stationary}
+    incr("directions_cache.hits", len(cached))
+    incr("directions_cache.misses", len(missing))
+    fetched = {}
+    if missing:
+        sequence = [legs[0][0]] + [destination for _, destination in legs]
+        consecutive = all(legs[k][1] == legs[k + 1][0] for k in range(len(legs) - 1))
+        if single_request and consecutive and len(sequence) - 2 <= MAX_DIRECTIONS_WAYPOINTS:
+            fetched = {key: points for key, points in zip(keys, _fetch_route_legs(sequence, gmaps_client, mode))}
+            incr("api.directions")
+        else:
+            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(missing))) as pool:
+                results = pool.map(lambda leg: _fetch_leg(leg[0], leg[1], gmaps_client, mode), missing.values())
+                fetched = dict(zip(missing, results))
+            incr("api.directions", len(missing))
+        if cache:
+            cache.set_many({key: points for key, points in fetched.items() if points is not None})
+
+    polylines = []
+    for key in keys:
+        points = None if key in stationary else cached.get(key) or fetched.get(key)
+        polylines.append(polyline.decode(points) if points else None)
+    return polylines
+
+
+def haversine_km(coords):
+    """Pairwise great-circle distances in km for an (n, 2) array of (lat, lng) degrees."""
+    coords = np.asarray(coords, dtype=float)
+    lat, lng = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlng / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+
+class MatrixProvider:
+    """
+    Source of travel matrices. get_matrices returns (time_matrix in minutes, distance_matrix in km)
+    as nested lists; `coords` are the stops' (lat, lng) when already known.
+    Providers with `time_dependent` set return travel times for departures at `hour` (0-23) when given;
+    the others ignore it. `hubs` are the node indices routes start and end at, which sparse providers
+    fetch every arc of; dense providers ignore them.
+    """
+    needs_coords = False
+    time_dependent = False
+
+    def get_matrices(self, address_list, coords=None, hour=None, hubs=None):
+        raise NotImplementedError
+
+
+class GoogleMatrixProvider(MatrixProvider):
+    """Google Distance Matrix with the pair-level travel cache (one cache bucket per departure hour)."""
+    time_dependent = True
+
+    def __init__(self, gmaps_client, mode='driving', cache=travel_cache):
+        self.gmaps_client = gmaps_client
+        self.mode = mode
+        self.cache = cache
+
+    def get_matrices(self, address_list, coords=None, hour=None, hubs=None):
+        return get_travel_matrices(address_list, self.gmaps_client, mode=self.mode, cache=self.cache, hour=hour)
+
+
+class EstimateMatrixProvider(MatrixProvider):
+    """
+    Offline estimate: Haversine distance times a road factor, driven at an average speed
+    (slowed down by `rush_hour_factors` for departures in those hours).
+    """
+    needs_coords = True
+    time_dependent = True
+
+    def __init__(self, road_factor=ROAD_FACTOR, speed_kmh=AVERAGE_SPEED_KMH, rush_hour_factors=None):
+        self.road_factor = road_factor
+        self.speed_kmh = speed_kmh
+        self.rush_hour_factors = RUSH_HOUR_FACTORS if rush_hour_factors is None else rush_hour_factors
+
+    def get_matrices(self, address_list, coords=None, hour=None, hubs=None):
+        coords = np.asarray(coords, dtype=float)
+        distance_matrix = haversine_km(coords) * self.road_factor
+        speed_kmh = self.speed_kmh
+        if hour is not None:
+            speed_kmh /= self.rush_hour_factors.get(hour, 1.0)
+
+        # stops that could not be geocoded are unreachable
+        unknown = np.isnan(coords).any(axis=1)
+        distance_matrix[unknown, :] = distance_matrix[:, unknown] = UNREACHABLE_KM
+        time_matrix = np.rint(distance_matrix / speed_kmh * 60).astype(int)
+        time_matrix[unknown, :] = time_matrix[:, unknown] = UNREACHABLE_MINUTES
+        np.fill_diagonal(time_matrix, 0)
+        np.fill_diagonal(distance_matrix, 0)
+        return time_matrix.tolist(), distance_matrix.round(3).tolist()
+
+
+def candidate_arcs(coords, neighbors, hubs=(0,)):
+    """
+    {i: [j, ...]} arcs worth real travel times: each node's `neighbors` nearest nodes by great-circle
+    distance, in both directions, plus every arc into and out of the `hubs` (the nodes routes start
+    and end at; the origin by default).
+    """
+    n = len(coords)
+    distances = haversine_km(coords)
+    np.fill_diagonal(distances, np.inf)
+    # stops that could not be geocoded (NaN) sort last and are only reached through the hubs
+    nearest = np.argsort(np.nan_to_num(distances, nan=np.inf), axis=1)[:, :neighbors]
+
+    arcs = {i: set() for i in range(n)}
+    for i in range(n):
+        for j in nearest[i].tolist():
+            arcs[i].add(j)
+            arcs[j].add(i)
+    for hub in hubs:
         for j in range(n):
-            element = response['rows'][0]['elements'][j]
+            if j != hub:
+                arcs[hub].add(j)
+                arcs[j].add(hub)
+    return {i: sorted(dests) for i, dests in arcs.items()}
 
-            # Check that distance info is valid
-            if element['status'] == 'OK':
-                distance_in_km = element['distance']['value'] / 1000  # meters → km
-            else:
-                print(f"Warning: distance_matrix[{i}][{j}] status = {element['status']}")
-                distance_in_km = 9999  # fallback value
 
-            distance_matrix[i][j] = distance_in_km
+class SparseMatrixProvider(GoogleMatrixProvider):
+    """
+    Google travel times for candidate arcs only (see candidate_arcs), so requests and cache entries
+    grow with n * neighbors instead of n². The other pairs are filled by the offline estimate, scaled
+    to agree with the fetched pairs ("estimate"), or marked unreachable so the solver never uses them ("forbid").
+    """
+    needs_coords = True
+
+    def __init__(self, gmaps_client, neighbors=MATRIX_NEIGHBORS, fill=SPARSE_FILL, mode='driving', cache=travel_cache):
+        if fill not in SPARSE_FILLS:
+            raise ValueError(f"Unknown sparse fill '{fill}', expected one of {', '.join(SPARSE_FILLS)}")
+        super().__init__(gmaps_client, mode=mode, cache=cache)
+        self.neighbors = neighbors
+        self.fill = fill
+        self.estimate = EstimateMatrixProvider()
+
+    def get_matrices(self, address_list, coords=None, hour=None, hubs=None):
+        n = len(address_list)
+        if n <= self.neighbors + 1:
+            return super().get_matrices(address_list, coords, hour)
+
+        arcs = candidate_arcs(coords, self.neighbors, hubs or (0,))
+        subset = [(i, j) for i, dests in arcs.items() for j in dests]
+        pairs = get_travel_pairs(address_list, self.gmaps_client, mode=self.mode, cache=self.cache,
+                                 subset=subset, hour=hour)
+        incr("sparse_matrix.fetched_pairs", len(subset))
+
+        if self.fill == "forbid":
+            time_matrix = np.full((n, n), UNREACHABLE_MINUTES)
+            distance_matrix = np.full((n, n), float(UNREACHABLE_KM))
+        else:
+            estimated_time, estimated_distance = (np.asarray(m, dtype=float) for m in self.estimate.get_matrices(
+                address_list, coords, hour
+            ))
+            fetched = [(i, j, pair_time_distance(pair)) for (i, j), pair in pairs.items() if pair is not None]
+
+            # the estimate is scaled by the median real/estimated ratio over the fetched pairs
+            def scale(estimated, column):
+                ratios = [values[column] / estimated[i, j] for i, j, values in fetched if estimated[i, j] > 0]
+                return float(np.median(ratios)) if ratios else 1.0
+
+            time_matrix = np.rint(estimated_time * scale(estimated_time, 0)).astype(int)
+            distance_matrix = (estimated_distance * scale(estimated_distance, 1)).round(3)
+            unknown = estimated_time >= UNREACHABLE_MINUTES
+            time_matrix[unknown] = UNREACHABLE_MINUTES
+            distance_matrix[unknown] = UNREACHABLE_KM
+
+        for (i, j), pair in pairs.items():
+            time_matrix[i, j], distance_matrix[i, j] = pair_time_distance(pair)
+        np.fill_diagonal(time_matrix, 0)
+        np.fill_diagonal(distance_matrix, 0)
+        return time_matrix.tolist(), distance_matrix.tolist()
+
+
+class OSRMMatrixProvider(MatrixProvider):
+    """Locally hosted OSRM-compatible routing engine (the /table service)."""
+    needs_coords = True
+
+    def __init__(self, base_url=OSRM_URL, profile='driving', timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.profile = profile
+        self.timeout = timeout
+
+    def get_matrices(self, address_list, coords=None, hour=None, hubs=None):
+        # OSRM takes lng,lat pairs
+        locations = ";".join(f"{lng},{lat}" for lat, lng in coords)
+        response = requests.get(
+            f"{self.base_url}/table/v1/{self.profile}/{locations}",
+            params={"annotations": "duration,distance"},
+            timeout=self.timeout
+        )
+        incr("api.osrm_table")
+        response.raise_for_status()
+        table = response.json()
+        if table.get("code") != "Ok":
+            raise RuntimeError(f"OSRM table request failed: {table.get('code')} {table.get('message', '')}")
+
+        time_matrix = [
+            [int(duration // 60) if duration is not None else UNREACHABLE_MINUTES for duration in row]
+            for row in table["durations"]
+        ]
+        distance_matrix = [
+            [distance / 1000 if distance is not None else UNREACHABLE_KM for distance in row]
+            for row in table["distances"]
+        ]
+        return time_matrix, distance_matrix
+
+
+MATRIX_PROVIDERS = {
+    "google": GoogleMatrixProvider,
+    "sparse": SparseMatrixProvider,
+    "estimate": EstimateMatrixProvider,
+    "osrm": OSRMMatrixProvider,
+}
+
 
-    return distance_matrix
+def get_matrix_provider(name=None, gmaps_client=None):
+    """Builds the provider registered under `name` (defaults to MATRIX_PROVIDER, else google); providers pass through."""
+    if isinstance(name, MatrixProvider):
+        return name
+    name = name or DEFAULT_MATRIX_PROVIDER
+    if name not in MATRIX_PROVIDERS:
+        raise ValueError(f"Unknown matrix provider '{name}', expected one of {', '.join(MATRIX_PROVIDERS)}")
+    if name in ("google", "sparse"):
+        return MATRIX_PROVIDERS[name](gmaps_client)
+    return MATRIX_PROVIDERS[name]()
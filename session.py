@@ -0,0 +1,172 @@
+from clients import get_gmaps_client
+from maps import GoogleMatrixProvider, geocode_addresses, get_matrix_provider, get_travel_pairs, pair_time_distance
+from vrptw import (
+    DEFAULT_PRIORITY,
+    build_matrices,
+    parse_instruction,
+    route_endpoints,
+    solve_route,
+    summarize_solution,
+    vehicle_starts_ends,
+)
+
+
+class RouteSession:
+    """
+    Keeps one plan's data dict, matrices and last solution in memory so that edits are cheap.
+    add_stop / remove_stop / edit_stop patch the data in place, fetch only the travel times
+    for the stop that changed, and re-solve warm-started from the previous visit order.
+    """
+
+    def __init__(self, data, gmaps_client=None, search_profile="fast", matrix_provider=None):
+        self.data = data
+        self.gmaps = gmaps_client or get_gmaps_client()
+        self.search_profile = search_profile
+        self.provider = get_matrix_provider(matrix_provider or data.get("matrix_provider"), self.gmaps)
+        self.visit_order = None
+        self.route_text = None
+        self.trip_summary = None
+        self.failed = False
+        if "time_matrix" not in data:
+            build_matrices(data, self.gmaps, self.provider)
+
+    @classmethod
+    def from_instruction(cls, instruction, **kwargs):
+        session = cls(parse_instruction(instruction), **kwargs)
+        session.solve()
+        return session
+
+    def solve(self):
+        """Solves the current data, from the previous routes when there are any. Returns the visit order."""
+        manager, routing, solution, self.failed = solve_route(
+            self.data,
+            profile=self.search_profile,
+            initial_routes=self.data.get("visit_orders")
+        )
+        if self.failed:
+            self.data.pop("visit_orders", None)
+            self.visit_order = self.route_text = self.trip_summary = None
+            return None
+        self.visit_order, self.route_text, self.trip_summary = summarize_solution(self.data, manager, routing, solution)
+        return self.visit_order
+
+    def add_stop(self, name, address, duration, time_window=(0, 1439), demand=0):
+        data = self.data
+        new = len(data["location_addresses"])
+        data["location_names"].append(name)
+        data["location_addresses"].append(address)
+        data["location_durations"].append(duration)
+        data["time_windows"].append(list(time_window))
+        if "location_demands" in data:
+            data["location_demands"].append(demand)
+        if "location_priorities" in data:
+            data["location_priorities"].append(DEFAULT_PRIORITY)
+        data["location_coords"].append(geocode_addresses([address], self.gmaps)[0])
+
+        for row in data["time_matrix"]:
+            row.append(0)
+        for row in data["distance_matrix"]:
+            row.append(0)
+        data["time_matrix"].append([0] * (new + 1))
+        data["distance_matrix"].append([0] * (new + 1))
+        self._refresh_travel(new)
+
+        if data.get("visit_orders"):
+            self._insert_cheapest(new)
+        return self.solve()
+
+    def remove_stop(self, stop):
+        data = self.data
+        k = self._index(stop)
+        starts, ends = vehicle_starts_ends(data)
+        if k in starts or k in ends:
+            raise ValueError(f"Cannot remove {data['location_names'][k]}: it starts or ends a route")
+
+        name = data["location_names"][k]
+        for key in ["location_names", "location_addresses", "location_durations", "time_windows",
+                    "location_coords", "location_demands", "location_priorities"]:
+            if key in data:
+                del data[key][k]
+        for key in ["time_matrix", "distance_matrix"]:
+            del data[key][k]
+            for row in data[key]:
+                del row[k]
+        data["precedence_constraints"] = [
+            pair for pair in data.get("precedence_constraints", []) if name not in pair
+        ]
+        def shift(node):
+            return node - 1 if node > k else node
+
+        data["depot"] = shift(data["depot"])
+        if "custom_end_index" in data:
+            data["custom_end_index"] = shift(data["custom_end_index"])
+        for key in ["vehicle_starts", "vehicle_ends"]:
+            if key in data:
+                data[key] = [shift(node) for node in data[key]]
+        if data.get("visit_orders"):
+            data["visit_orders"] = [[shift(node) for node in route if node != k] for route in data["visit_orders"]]
+        if "hourly_time_matrices" in data:
+            # hourly matrices are rebuilt from the travel cache rather than patched, once every index
+            # above is shifted, since sparse providers fetch all arcs of the route endpoints
+            build_matrices(data, self.gmaps, self.provider)
+        return self.solve()
+
+    def edit_stop(self, stop, name=None, address=None, duration=None, time_window=None):
+        data = self.data
+        k = self._index(stop)
+        if name is not None:
+            old_name = data["location_names"][k]
+            data["location_names"][k] = name
+            data["precedence_constraints"] = [
+                [name if n == old_name else n for n in pair] for pair in data.get("precedence_constraints", [])
+            ]
+        if duration is not None:
+            data["location_durations"][k] = duration
+        if time_window is not None:
+            data["time_windows"][k] = list(time_window)
+        if address is not None and address != data["location_addresses"][k]:
+            data["location_addresses"][k] = address
+            data["location_coords"][k] = geocode_addresses([address], self.gmaps)[0]
+            self._refresh_travel(k)
+        return self.solve()
+
+    def _index(self, stop):
+        if isinstance(stop, int):
+            return stop
+        return self.data["location_names"].index(stop)
+
+    def _refresh_travel(self, k):
+        """Re-fetches the matrix row and column of stop k."""
+        data = self.data
+        addresses = data["location_addresses"]
+        n = len(addresses)
+        if "hourly_time_matrices" in data:
+            # every hour bucket changes; cached pairs are not fetched again
+            build_matrices(data, self.gmaps, self.provider)
+        elif isinstance(self.provider, GoogleMatrixProvider):
+            subset = [(k, j) for j in range(n)] + [(i, k) for i in range(n) if i != k]
+            pairs = get_travel_pairs(addresses, self.gmaps, mode=self.provider.mode, cache=self.provider.cache, subset=subset)
+            for (i, j), pair in pairs.items():
+                data["time_matrix"][i][j], data["distance_matrix"][i][j] = pair_time_distance(pair)
+        else:
+            # offline providers rebuild the whole matrix faster than a network round trip
+            data["time_matrix"], data["distance_matrix"] = self.provider.get_matrices(
+                addresses, data["location_coords"], hubs=route_endpoints(data)
+            )
+
+    def _insert_cheapest(self, node):
+        """Adds a new stop to the previous routes where it adds the least travel time."""
+        time_matrix = self.data["time_matrix"]
+        best = None
+        for v, route in enumerate(self.data["visit_orders"]):
+            for position in range(1, len(route)):
+                before, after = route[position - 1], route[position]
+                cost = time_matrix[before][node] + time_matrix[node][after] - time_matrix[before][after]
+                if best is None or cost < best[0]:
+                    best = (cost, v, position)
+        if best is None:
+            # every vehicle was idle; let the solver place the stop
+            self.data.pop("visit_orders", None)
+            return
+        _, v, position = best
+        self.data["visit_orders"][v].insert(position, node)
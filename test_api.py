@@ -1,6 +1,8 @@
+import time
 import requests
 
-url = "http://127.0.0.1:5000/solve"
+base_url = "http://127.0.0.1:5000"
+url = f"{base_url}/solve"
 
 data = {
     "instruction": (
@@ -11,13 +13,16 @@ data = {
     )
 }
 
-# Send the POST request
+# Send the POST request; the solve runs in the background and is polled until it finishes
 response = requests.post(url, json=data)
 
-# Display result
-if response.status_code == 200:
-    print("✅ Success! Response:")
-    print(response.json())
+if response.status_code in (200, 202):
+    job = response.json()
+    while job["status"] in ("queued", "running"):
+        time.sleep(1)
+        job = requests.get(f"{base_url}{job['status_url']}").json()
+    print(f"✅ Job {job['job_id']} finished with status {job['status']}:")
+    print(job.get("result") or job.get("error"))
 else:
     print(f"❌ Request failed with status {response.status_code}")
     print(response.text)
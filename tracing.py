@@ -0,0 +1,177 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger("route_optimiser")
+
+_current_trace = contextvars.ContextVar("route_trace", default=None)
+
+
+class Metrics:
+    """
+    Process-wide counters and stage timings, exported in the Prometheus text format.
+    Every trace also feeds these, so /metrics covers all requests served by the process.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, trace):
+        """Folds a trace dict recorded in another process (e.g. a job worker) into these metrics."""
+        if not trace:
+            return
+        for name, value in trace["counters"].items():
+            self.incr(name, value)
+        for recorded in trace["spans"]:
+            self.observe(recorded["name"], recorded["duration"])
+        if trace["duration"] is not None:
+            self.observe("total", trace["duration"])
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            count, total, slowest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds, max(slowest, seconds))
+
+    def prometheus_text(self):
+        with self._lock:
+            counters = dict(self.counters)
+            stages = dict(self.stages)
+        lines = [
+            "# HELP route_events_total Calls, cache lookups and other events by name.",
+            "# TYPE route_events_total counter",
+        ]
+        for name, value in sorted(counters.items()):
+            lines.append(f'route_events_total{{event="{name}"}} {value}')
+        lines += [
+            "# HELP route_stage_seconds Wall time spent per pipeline stage.",
+            "# TYPE route_stage_seconds summary",
+        ]
+        for stage, (count, total, _) in sorted(stages.items()):
+            lines.append(f'route_stage_seconds_count{{stage="{stage}"}} {count}')
+            lines.append(f'route_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines += [
+            "# HELP route_stage_seconds_max Slowest observation per pipeline stage.",
+            "# TYPE route_stage_seconds_max gauge",
+        ]
+        for stage, (_, _, slowest) in sorted(stages.items()):
+            lines.append(f'route_stage_seconds_max{{stage="{stage}"}} {slowest:.6f}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """
+    Spans, counters and attributes collected while handling one request.
+    Start one with `with Trace() as trace:`; span(), incr() and annotate() anywhere below it
+    (including threads started with asyncio.to_thread) record into it.
+    """
+
+    def __init__(self, name="run_vrptw"):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []
+        self.counters = {}
+        self.attributes = {}
+        self._token = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self._start
+        _current_trace.reset(self._token)
+        metrics.observe("total", self.duration)
+        logger.info(json.dumps({"trace": self.to_dict()}, default=str))
+        return False
+
+    def add_span(self, name, start, duration):
+        with self._lock:
+            self.spans.append({"name": name, "start": round(start - self._start, 6), "duration": round(duration, 6)})
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "trace_id": self.id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration": round(self.duration, 6) if self.duration is not None else None,
+                "spans": list(self.spans),
+                "counters": dict(self.counters),
+                "attributes": dict(self.attributes),
+            }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as a stage of the current trace (and of the process metrics)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe(name, duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, duration)
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed(name, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) inside span(name); handy with asyncio.to_thread."""
+    with span(name):
+        return func(*args, **kwargs)
+
+
+def incr(name, amount=1):
+    """Counts an event (API call, cache hit, ...) on the current trace and the process metrics."""
+    if not amount:
+        return
+    metrics.incr(name, amount)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.incr(name, amount)
+
+
+def annotate(**attributes):
+    """Attaches attributes (solver objective, profile, ...) to the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.attributes.update(attributes)
@@ -1,70 +1,149 @@
 import streamlit as st
 import streamlit.components.v1 as components
-from vrptw import run_vrptw, build_timeline
+from vrptw import run_vrptw_stream, render_route_map, build_timeline, SEARCH_PROFILES
+from artifacts import ArtifactStore, artifact_key, map_store
+from maps import MATRIX_PROVIDERS
 import plotly.express as px
 
 st.set_page_config(page_title="Route Optimiser", layout="centered")
 
+MATRIX_PROVIDER_LABELS = {
+    "google": "Google Maps (live traffic data)",
+    "sparse": "Google Maps for nearby stops, estimates elsewhere (large days)",
+    "estimate": "Quick estimate (offline)",
+    "osrm": "Local routing engine (OSRM)",
+}
+
+
+
+@st.cache_resource
+def finished_runs():
+    """Events of completed runs by input, shared by every session so a repeated plan is shown instantly."""
+    return ArtifactStore()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def timeline_figure(location_names, visit_order, arrival_departure_info):
+    timeline_df = build_timeline({"location_names": location_names}, visit_order, arrival_departure_info)
+    fig = px.timeline(
+        timeline_df, x_start="Start", x_end="End", y="Task", color="Category",
+        title="Visual Schedule of the Day"
+    )
+    fig.update_yaxes(autorange="reversed")
+    fig.update_layout(height=500)
+    return fig
+
+
+def show_solved(solved):
+    """Trip summary and timeline, drawn as soon as the route is solved; returns placeholders for the rest."""
+    trip_summary = solved["trip_summary"]
+    data = solved["data"]
+    st.success("✅ Route generated successfully!")
+    if trip_summary.get("dropped_stops") or trip_summary.get("late_stops"):
+        st.warning(
+            "⚠️ Not every constraint could be met. "
+            f"Skipped: {', '.join(trip_summary['dropped_stops']) or 'none'}. "
+            f"Arriving after closing: {', '.join(trip_summary['late_stops']) or 'none'}."
+            + "".join(f"\n- {reason}" for reason in trip_summary.get("unmet_reasons", []))
+        )
+
+    # 🧽 Trip Summary
+    st.markdown("### 🧽 Trip Summary")
+    st.markdown(f"""
+    - **Total Stops**: {trip_summary["total_stops"]}
+    - **Total Distance**: {trip_summary["total_distance"]:.1f} km
+    - **Total Travel Time**: {trip_summary["total_travel_time"]:.0f} min
+    - **Time Spent at Stops**: {trip_summary["total_stop_time"]:.0f} min
+    - **Return to Origin**: {"Yes" if trip_summary["return_to_start"] else "No"}
+
+    **Departure**: {trip_summary["start_time"]}  
+    **Final Arrival**: {trip_summary["end_time"]}
+    """)
+
+    # 📝 Itinerary, 🗌 Route Map and 🧠 Route Logic Explanation fill in as they finish
+    st.markdown("### 📝 Detailed Schedule")
+    placeholders = {"itinerary": st.empty()}
+    st.markdown("### 🗌 Route Map")
+    placeholders["map"] = st.empty()
+    st.markdown("### 🧠 Why this route?")
+    placeholders["explanation"] = st.empty()
+    for placeholder in placeholders.values():
+        placeholder.caption("⏳ Working on it...")
+
+    # ⏱️ Timeline Visualiser
+    st.markdown("### ⏱️ Timeline of the Day")
+    st.plotly_chart(
+        timeline_figure(data["location_names"], solved["visit_order"], data["arrival_departure_info"]),
+        use_container_width=True
+    )
+    return placeholders
+
+
+def show_map(placeholder, map_id, solved):
+    html = map_store.get(map_id)
+    if html is None:
+        # a replayed run whose map has since been evicted from the store
+        html = map_store.get(render_route_map(solved["data"], solved["visit_order"], solved["trip_summary"]))
+    with placeholder.container():
+        components.html(html, height=600, scrolling=True)
+
+
 st.title("🚚 Vehicle Routing with Time Windows")
 st.markdown("Please enter your day's plan and we will compute the best route for you.")
 
 # User instruction input box
 user_instruction = st.text_area("Enter your plans:", height=250)
+search_profile = st.selectbox(
+    "Optimisation effort:", list(SEARCH_PROFILES), index=list(SEARCH_PROFILES).index("balanced")
+)
+matrix_provider = st.selectbox(
+    "Travel times:", list(MATRIX_PROVIDERS), format_func=lambda name: MATRIX_PROVIDER_LABELS.get(name, name)
+)
+polish_itinerary = st.checkbox("Have GPT rewrite the schedule (slower)", value=False)
 
 # Button to generate route
 if st.button("Generate Optimised Route"):
     if not user_instruction.strip():
         st.warning("⚠️ Please enter your daily plans first.")
     else:
-        with st.spinner("Generating your optimised route..."):
-            try:
-                # Get output from core solver
-                map_file, summary, trip_summary, explanation, error_explanation, visit_order, data = run_vrptw(user_instruction)
-
-                if error_explanation:
-                    st.error("❌ GPT Error Explanation:")
-                    st.write(error_explanation)
-                else:
-                    st.success("✅ Route generated successfully!")
-
-                    # 🧽 Trip Summary
-                    st.markdown("### 🧽 Trip Summary")
-                    st.markdown(f"""
-                    - **Total Stops**: {trip_summary["total_stops"]}
-                    - **Total Distance**: {trip_summary["total_distance"]:.1f} km
-                    - **Total Travel Time**: {trip_summary["total_travel_time"]:.0f} min
-                    - **Time Spent at Stops**: {trip_summary["total_stop_time"]:.0f} min
-                    - **Return to Origin**: {"Yes" if trip_summary["return_to_start"] else "No"}
-
-                    **Departure**: {trip_summary["start_time"]}  
-                    **Final Arrival**: {trip_summary["end_time"]}
-                    """)
-
-                    # 📝 GPT Text Summary
-                    st.markdown("### 📝 Detailed Schedule")
-                    st.text(summary)
-
-                    # 🗌 Route Map
-                    st.markdown("### 🗌 Route Map")
-                    with open(map_file, 'r', encoding='utf-8') as f:
-                        html_string = f.read()
-                        components.html(html_string, height=600, scrolling=True)
-
-                    # 🧠 Route Logic Explanation
-                    st.markdown("### 🧠 Why this route?")
-                    st.info(explanation)
-
-                    # ⏱️ Timeline Visualiser
-                    st.markdown("### ⏱️ Timeline of the Day")
-                    timeline_df = build_timeline(data, visit_order, data["arrival_departure_info"])
-                    fig = px.timeline(
-                        timeline_df, x_start="Start", x_end="End", y="Task", color="Category", 
-                        title="Visual Schedule of the Day"
-                    )
-                    fig.update_yaxes(autorange="reversed")
-                    fig.update_layout(height=500)
-                    st.plotly_chart(fig, use_container_width=True)
-
-
-            except Exception as e:
-                st.error(f"❌ Error while generating route: {e}")
+        itinerary_mode = "llm" if polish_itinerary else "template"
+        run_key = artifact_key(user_instruction, search_profile, matrix_provider, itinerary_mode)
+        cached_events = finished_runs().get(run_key)
+        status = st.empty()
+        status.info("⏳ Solving your route...")
+        try:
+            # Each part is drawn as soon as the core solver yields it
+            events = cached_events or run_vrptw_stream(user_instruction, search_profile, matrix_provider, itinerary_mode)
+            recorded = []
+            streamed = {"itinerary_token": "", "explanation_token": ""}
+            solved = placeholders = None
+            for event, payload in events:
+                if event in streamed:
+                    streamed[event] += payload
+                    if event == "itinerary_token":
+                        placeholders["itinerary"].text(streamed[event])
+                    else:
+                        placeholders["explanation"].info(streamed[event])
+                    continue
+                recorded.append((event, payload))
+
+                if event == "failed":
+                    status.empty()
+                    st.error("❌ Error Explanation:")
+                    st.write(payload)
+                elif event == "solved":
+                    status.empty()
+                    solved = payload
+                    placeholders = show_solved(solved)
+                elif event == "itinerary":
+                    placeholders["itinerary"].text(payload)
+                elif event == "explanation":
+                    placeholders["explanation"].info(payload)
+                elif event == "map":
+                    show_map(placeholders["map"], payload, solved)
+                elif event == "done" and not cached_events:
+                    finished_runs().put(run_key, recorded)
+
+        except Exception as e:
+            status.empty()
+            st.error(f"❌ Error while generating route: {e}")
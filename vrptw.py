@@ -1,24 +1,73 @@
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 from gpt_interface import get_data
-import googlemaps
-import folium
-from folium.plugins import AntPath
-import time
-from maps import get_time_matrix
-from maps import get_distance_matrix
-import polyline
+from clients import GOOGLEMAPS_API_KEY, get_gmaps_client, get_openai_client
+from maps import UNREACHABLE_MINUTES, geocode_addresses, get_leg_polylines, get_matrix_provider
+from artifacts import array_digest, artifact_key, map_store
+from tracing import Trace, annotate, incr, logger, span, timed, traced
+from itinerary import clock_to_minutes, minutes_to_clock, render_itinerary
+from diagnose import diagnose_infeasibility, explain_infeasibility
+from decompose import should_decompose, solve_decomposed
 import os
 from dotenv import load_dotenv
 import json
-import openai
-import pandas as pd
-import plotly.express as px
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import numpy as np
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
-GOOGLEMAPS_API_KEY = os.getenv("GOOGLEMAPS_API_KEY")
-gmaps = googlemaps.Client(key=GOOGLEMAPS_API_KEY)
+
+# Solver search profiles.
+# metaheuristics: (max_nodes, metaheuristic) tiers, the first tier the problem fits in is used.
+# time_limit: (base_seconds, seconds_per_node, max_seconds).
+# Greedy descent stops at the first local optimum, so tiny problems return as soon as they are solved.
+SEARCH_PROFILES = {
+    "fast": {
+        "first_solution_strategy": "PATH_CHEAPEST_ARC",
+        "metaheuristics": [(None, "GREEDY_DESCENT")],
+        "time_limit": (1, 0.02, 5),
+    },
+    "balanced": {
+        "first_solution_strategy": "PATH_CHEAPEST_ARC",
+        "metaheuristics": [(12, "GREEDY_DESCENT"), (None, "GUIDED_LOCAL_SEARCH")],
+        "time_limit": (1, 0.05, 30),
+    },
+    "quality": {
+        "first_solution_strategy": "PARALLEL_CHEAPEST_INSERTION",
+        "metaheuristics": [(8, "GREEDY_DESCENT"), (200, "GUIDED_LOCAL_SEARCH"), (None, "SIMULATED_ANNEALING")],
+        "time_limit": (2, 0.2, 120),
+    },
+}
+DEFAULT_SEARCH_PROFILE = os.getenv("SEARCH_PROFILE", "balanced")
+# "template" renders the itinerary locally; "llm" has gpt-4o rewrite it (slower, costs a call)
+DEFAULT_ITINERARY_MODE = os.getenv("ITINERARY_MODE", "template")
+ITINERARY_MODES = ("template", "llm")
+# length of the time dimension in minutes; relaxed windows span all of it (see diagnose.relax)
+HORIZON = 10000
+# soft constraints: "off" keeps every window hard and every stop mandatory, "always" solves with
+# soft windows and droppable stops, "fallback" does so only when the hard model has no solution
+SOFT_CONSTRAINTS = os.getenv("SOFT_CONSTRAINTS", "fallback")
+SOFT_CONSTRAINT_MODES = ("off", "fallback", "always")
+# cost per minute a stop is reached after its window closes (travel costs 1 per minute)
+LATENESS_PENALTY = int(os.getenv("LATENESS_PENALTY", 100))
+# a stop is never reached more than this many minutes after it closes; past that it is dropped instead
+MAX_LATENESS = int(os.getenv("MAX_LATENESS", 60))
+# cost of leaving a stop out, by location_priorities value (1 = optional, 2 = normal, 3 = important)
+DEFAULT_PRIORITY = 2
+PRIORITY_DROP_PENALTIES = {1: 5000, 2: 50000, 3: 500000}
+# time-dependent travel: one matrix per departure hour, re-solving until each stop's departure
+# hour matches the matrix row used for it (or the iteration limit is reached)
+TIME_DEPENDENT = os.getenv("TIME_DEPENDENT", "false").lower() in ("1", "true", "yes")
+MAX_TIME_DEPENDENT_ITERATIONS = int(os.getenv("MAX_TIME_DEPENDENT_ITERATIONS", 4))
+# "local" diagnoses failed solves from the matrix and constraints; "llm" asks gpt-4o instead
+DIAGNOSIS_MODE = os.getenv("DIAGNOSIS_MODE", "local")
+# improvement-rate stop: smaller values stop the search sooner once progress stalls
+IMPROVEMENT_RATE_COEFFICIENT = 2.5
 
 # helpers 
 
@@ -32,11 +81,14 @@ def build_timeline(data, visit_order, arrival_departure_info):
     Build a timeline DataFrame from visit order and arrival/departure info.
     This is intended for use with Plotly timeline visualizations.
     """
+    import pandas as pd
+
     timeline = []
 
-    for idx in visit_order:
+    # arrival_departure_info lists (node, arrival, departure) in visit order
+    for idx, (_, arrival, departure) in zip(visit_order, arrival_departure_info):
         name = data["location_names"][idx]
-        arrival, departure = arrival_departure_info[idx]
+        arrival, departure = clock_to_minutes(arrival), clock_to_minutes(departure)
 
 
         timeline.append({
@@ -48,14 +100,81 @@ def build_timeline(data, visit_order, arrival_departure_info):
 
     return pd.DataFrame(timeline)
 
-def build_matrices(data, gmaps):
+@traced("matrices")
+def build_matrices(data, gmaps, provider=None):
+    """
+    Adds travel time and distance matrices to the data dictionary, along with the geocoded
+    coordinates of every stop for reuse further down the pipeline.
+    `provider` (or data["matrix_provider"]) picks the matrix source: google, sparse, estimate or osrm.
+    With TIME_DEPENDENT (or data["time_dependent"]), per-hour matrices are added as well.
+    """
+    addresses = data["location_addresses"]
+    matrix_provider = get_matrix_provider(provider or data.get("matrix_provider"), gmaps)
+    if "location_coords" not in data:
+        data["location_coords"] = geocode_addresses(addresses, gmaps)
+    data["time_matrix"], data["distance_matrix"] = matrix_provider.get_matrices(
+        addresses, data["location_coords"], hubs=route_endpoints(data)
+    )
+    if data.get("time_dependent", TIME_DEPENDENT):
+        build_time_dependent_matrices(data, matrix_provider)
+
+
+def time_buckets(data):
+    """Hours of the day the plan can be on the road in, from the earliest departure to the latest realistic arrival."""
+    closes = [window[1] for window in data["time_windows"]]
+    if data.get("vehicle_shifts"):
+        closes += [shift[1] for shift in data["vehicle_shifts"]]
+    else:
+        closes.append(data.get("depot_return_window", [0, 1439])[1])
+    first = departure_bounds(data)[0] // 60
+    last = min(max(closes), latest_arrival(data), 1439) // 60
+    return list(range(first, max(first, last) + 1))
+
+
+def departure_bounds(data):
+    """(earliest, latest) departure over the fleet: the vehicle shifts' starts when given, else the depot departure window."""
+    shifts = data.get("vehicle_shifts")
+    if shifts:
+        return min(shift[0] for shift in shifts), max(shift[1] for shift in shifts)
+    return tuple(data["depot_departure_window"])
+
+
+def latest_arrival(data):
     """
-    Adds travel time and distance matrices to the data dictionary using Google Maps.
+    Estimate of the latest minute a route is still driving: it leaves at the latest departure or waits for
+    the last stop to open, then serves every stop over a typical (median) leg into each, plus an hour of slack.
+    Default [0, 1439] windows would otherwise stretch the buckets to the end of the day.
     """
+    time_matrix = np.asarray(data["time_matrix"], dtype=float)
+    time_matrix[time_matrix >= UNREACHABLE_MINUTES] = np.nan
+    np.fill_diagonal(time_matrix, np.nan)
+    inbound = np.nan_to_num(np.nanmedian(time_matrix, axis=0)) if len(time_matrix) > 1 else np.zeros(1)
+    starts = [window[0] for window in data["time_windows"]]
+    starts.append(departure_bounds(data)[1])
+    return int(max(starts) + sum(data["location_durations"]) + inbound.sum() + 60)
+
+
+@traced("hourly_matrices")
+def build_time_dependent_matrices(data, matrix_provider):
+    """
+    Adds data["hourly_time_matrices"] ({hour: time matrix}) for every hour in time_buckets, and keeps
+    the hour-independent matrix in data["static_time_matrix"]. Hour buckets are cached by the provider,
+    so a plan in the same area reuses them instead of refetching.
+    Providers without time-dependent travel times are left static.
+    """
+    if not matrix_provider.time_dependent:
+        logger.warning("Matrix provider has no time-dependent travel times, using the static matrix")
+        return
     addresses = data["location_addresses"]
-    data["time_matrix"] = get_time_matrix(addresses, gmaps)
-    data["distance_matrix"] = get_distance_matrix(addresses, gmaps)
+    data["time_dependent"] = True
+    data["static_time_matrix"] = data["time_matrix"]
+    data["hourly_time_matrices"] = {
+        hour: matrix_provider.get_matrices(addresses, data["location_coords"], hour=hour, hubs=route_endpoints(data))[0]
+        for hour in time_buckets(data)
+    }
+    data.pop("node_hours", None)
 
+@traced("parse")
 def parse_instruction(instruction):
     """
     Parses the user's natural language instruction into structured routing data.
@@ -69,20 +188,30 @@ def parse_instruction(instruction):
 
     # Simple check
     if data["depot"] != 0:
-        print("⚠️ Warning: Depot index is not zero. Check the instruction format.")
+        logger.warning("Depot index is not zero. Check the instruction format.")
 
     return data
 
-def load_user_instruction(file_path, scenario_name):
-    """Load the user instruction for a given scenario name."""
+def load_user_instructions(file_path):
+    """Load every scenario in a scenario file as {scenario name: instruction}."""
     with open(file_path, 'r', encoding='utf-8') as f:
         content = f.read()
     # Split by === to find scenarios
-    scenarios = content.split('=== ')
-    for scenario in scenarios:
-        if scenario.strip().startswith(f"Scenario: {scenario_name}"):
-            # Remove the first line and return the rest
-            return '\n'.join(scenario.strip().split('\n')[1:]).strip()
+    instructions = {}
+    for scenario in content.split('=== '):
+        lines = scenario.strip().split('\n')
+        if lines[0].startswith("Scenario: "):
+            # the first line names the scenario, the rest is the instruction
+            name = lines[0][len("Scenario: "):].strip(" =")
+            instructions[name] = '\n'.join(lines[1:]).strip()
+    return instructions
+
+
+def load_user_instruction(file_path, scenario_name):
+    """Load the user instruction for a given scenario name."""
+    instructions = load_user_instructions(file_path)
+    if scenario_name in instructions:
+        return instructions[scenario_name]
     raise ValueError(f"Scenario '{scenario_name}' not found in {file_path}.")
 
 
@@ -96,126 +225,150 @@ def visualize_route(
     arrival_departure_info,
     return_to_start=True,
     map_style='CartoDB positron',
-    api_key=""
+    api_key="",
+    coords=None,
+    single_request=False,
+    vehicle_routes=None
 ):
     """
-    Creates an interactive Folium map of the optimized route with rich popups.
+    Creates an interactive Folium map of the optimized route with rich popups and returns its HTML.
+    Pass the stops' `coords` (as stored by build_matrices) to skip geocoding.
+    With `single_request`, uncached legs come from one multi-waypoint directions call.
+    For fleets, pass `vehicle_routes` as (visit_order, arrival_departure_info) per vehicle;
+    each driver's route is then drawn in its own color.
     """
-    gmaps = googlemaps.Client(key=api_key)
+    # folium is only needed for maps, so solver-only processes never import it
+    import folium
 
-    # Geocode all addresses to get lat/lon
-    lat_list = []
-    lon_list = []
-    for addy in address_list:
-        loc = gmaps.geocode(addy)[0]['geometry']['location']
-        lat_list.append(loc['lat'])
-        lon_list.append(loc['lng'])
-        time.sleep(0.1)
+    gmaps = get_gmaps_client(api_key or None)
 
-    route_coords = [(lat_list[i], lon_list[i]) for i in visit_order]
-    m = folium.Map(location=route_coords[0], zoom_start=10, tiles=map_style)
+    if coords is None:
+        coords = geocode_addresses(address_list, gmaps)
+    lat_list = [lat for lat, _ in coords]
+    lon_list = [lon for _, lon in coords]
 
-    # Build lookup for arrival/departure
-    time_lookup = {node: (arr, dep) for node, arr, dep in arrival_departure_info}
+    routes = vehicle_routes or [(visit_order, arrival_departure_info)]
+    route_coords = [coords[i] for route, _ in routes for i in route if coords[i][0] is not None]
+    m = folium.Map(location=route_coords[0], zoom_start=10, tiles=map_style)
 
-    # Add markers
-    for stop_num, node in enumerate(visit_order):
-        if stop_num == len(visit_order) - 1 and return_to_start:
-            continue
-        arrival, departure = time_lookup.get(node, ("?", "?"))
-        popup = f"""<div style='width: 280px; font-size: 14px; font-family: Arial; line-height: 1.5'>
-        <b style="font-size: 16px;">{location_names[node]}</b><br>
-        <span style='font-size:13px'>{address_list[node]}</span><br><br>
-        <b>Arrival:</b> {arrival}<br>
-        <b>Departure:</b> {departure}<br>
-        <b>Time Spent:</b> {'Depot / Home' if location_durations[node] == 0 else f"{location_durations[node]} minutes"}
-        </div>"""
-        icon_color = 'green' if stop_num == 0 else 'red'
-        folium.Marker(
-            [lat_list[node], lon_list[node]],
-            popup=popup,
-            icon=folium.DivIcon(html=f"""
-                <div style='background-color: {icon_color}; color: white; border-radius: 50%;
-                            width: 30px; height: 30px; text-align: center; line-height: 30px;
-                            font-weight: bold; font-size: 14px;'>{stop_num + 1}</div>""")
-        ).add_to(m)
-
-    # Draw segments
     colors = ['blue', 'green', 'orange', 'purple', 'gold', 'pink', 'gray']
-    for i in range(len(visit_order) - 1):
-        from_i = visit_order[i]
-        to_i = visit_order[i + 1]
-        origin = address_list[from_i]
-        destination = address_list[to_i]
-        directions = gmaps.directions(origin, destination, mode='driving')
-        if directions:
-            poly = directions[0]['overview_polyline']['points']
-            decoded = polyline.decode(poly)
-            travel_time = time_matrix[from_i][to_i]
-            travel_dist = distance_matrix[from_i][to_i]
-            from_dep = time_lookup.get(from_i, ("", ""))[1]
-            to_arr = time_lookup.get(to_i, ("", ""))[0]
-
-            popup = f"""
-            <div style='width: 320px; font-size: 14px; font-family: Arial; line-height: 1.6'>
-            <b style="font-size: 15px;">Route Segment</b><br>
-            <b>From:</b> {location_names[from_i]}<br>
-            <span style='font-size:13px'>{address_list[from_i]}</span><br>
-            <b>To:</b> {location_names[to_i]}<br>
-            <span style='font-size:13px'>{address_list[to_i]}</span><br><br>
-            <b>Departure:</b> {from_dep}<br>
-            <b>Arrival:</b> {to_arr}<br>
-            <b>Travel Time:</b> {travel_time:.1f} min<br>
-            <b>Distance:</b> {travel_dist:.1f} km
-            </div>
-            """
-
-            folium.PolyLine(
-                decoded,
-                color=colors[i % len(colors)],
-                weight=7,
-                opacity=0.85,
-                popup=popup
+    for vehicle_id, (visit_order, arrival_departure_info) in enumerate(routes):
+        if not visit_order:
+            continue
+        if vehicle_routes:
+            return_to_start = visit_order[-1] == visit_order[0]
+            route_colors = [colors[vehicle_id % len(colors)]]
+            driver_label = f"Driver {vehicle_id} · "
+        else:
+            route_colors = colors
+            driver_label = ""
+
+        # Build lookup for arrival/departure
+        time_lookup = {node: (arr, dep) for node, arr, dep in arrival_departure_info}
+
+        # Add markers
+        for stop_num, node in enumerate(visit_order):
+            if stop_num == len(visit_order) - 1 and return_to_start:
+                continue
+            if lat_list[node] is None:
+                continue
+            arrival, departure = time_lookup.get(node, ("?", "?"))
+            popup = f"""<div style='width: 280px; font-size: 14px; font-family: Arial; line-height: 1.5'>
+            <b style="font-size: 16px;">{driver_label}{location_names[node]}</b><br>
+            <span style='font-size:13px'>{address_list[node]}</span><br><br>
+            <b>Arrival:</b> {arrival}<br>
+            <b>Departure:</b> {departure}<br>
+            <b>Time Spent:</b> {'Depot / Home' if location_durations[node] == 0 else f"{location_durations[node]} minutes"}
+            </div>"""
+            icon_color = 'green' if stop_num == 0 else (route_colors[0] if vehicle_routes else 'red')
+            folium.Marker(
+                [lat_list[node], lon_list[node]],
+                popup=popup,
+                icon=folium.DivIcon(html=f"""
+                    <div style='background-color: {icon_color}; color: white; border-radius: 50%;
+                                width: 30px; height: 30px; text-align: center; line-height: 30px;
+                                font-weight: bold; font-size: 14px;'>{stop_num + 1}</div>""")
             ).add_to(m)
 
-    # Return to depot
-    if return_to_start:
-        from_i = visit_order[-1]
-        to_i = visit_order[0]
-        directions = gmaps.directions(address_list[from_i], address_list[to_i], mode='driving')
-        if directions:
-            poly = directions[0]['overview_polyline']['points']
-            decoded = polyline.decode(poly)
-            travel_time = time_matrix[from_i][to_i]
-            travel_dist = distance_matrix[from_i][to_i]
-            from_dep = time_lookup.get(from_i, ("", ""))[1]
-            to_arr = time_lookup.get(to_i, ("", ""))[0]
-
-            popup = f"""
-            <div style='width: 320px; font-size: 14px; font-family: Arial; line-height: 1.6'>
-            <b style="font-size: 15px;">Return to Depot</b><br>
-            <b>From:</b> {location_names[from_i]}<br>
-            <span style='font-size:13px'>{address_list[from_i]}</span><br>
-            <b>To:</b> {location_names[to_i]}<br>
-            <span style='font-size:13px'>{address_list[to_i]}</span><br><br>
-            <b>Departure:</b> {from_dep}<br>
-            <b>Arrival:</b> {to_arr}<br>
-            <b>Travel Time:</b> {travel_time:.1f} min<br>
-            <b>Distance:</b> {travel_dist:.1f} km
-            </div>
-            """
-            
-            folium.PolyLine(
-                decoded,
-                color='black',
-                weight=7,
-                opacity=0.9,
-                popup=popup
-            ).add_to(m)
+        # Fetch every leg's polyline up front (cached, concurrent)
+        legs = [(visit_order[i], visit_order[i + 1]) for i in range(len(visit_order) - 1)]
+        if return_to_start:
+            legs.append((visit_order[-1], visit_order[0]))
+        leg_polylines = get_leg_polylines(
+            [(address_list[from_i], address_list[to_i]) for from_i, to_i in legs],
+            gmaps,
+            mode='driving',
+            single_request=single_request
+        )
+
+        # Draw segments
+        for i in range(len(visit_order) - 1):
+            from_i = visit_order[i]
+            to_i = visit_order[i + 1]
+            decoded = leg_polylines[i]
+            if decoded:
+                travel_time = time_matrix[from_i][to_i]
+                travel_dist = distance_matrix[from_i][to_i]
+                from_dep = time_lookup.get(from_i, ("", ""))[1]
+                to_arr = time_lookup.get(to_i, ("", ""))[0]
+
+                popup = f"""
+                <div style='width: 320px; font-size: 14px; font-family: Arial; line-height: 1.6'>
+                <b style="font-size: 15px;">{driver_label}Route Segment</b><br>
+                <b>From:</b> {location_names[from_i]}<br>
+                <span style='font-size:13px'>{address_list[from_i]}</span><br>
+                <b>To:</b> {location_names[to_i]}<br>
+                <span style='font-size:13px'>{address_list[to_i]}</span><br><br>
+                <b>Departure:</b> {from_dep}<br>
+                <b>Arrival:</b> {to_arr}<br>
+                <b>Travel Time:</b> {travel_time:.1f} min<br>
+                <b>Distance:</b> {travel_dist:.1f} km
+                </div>
+                """
+
+                folium.PolyLine(
+                    decoded,
+                    color=route_colors[i % len(route_colors)],
+                    weight=7,
+                    opacity=0.85,
+                    popup=popup
+                ).add_to(m)
+
+        # Return to depot
+        if return_to_start:
+            from_i = visit_order[-1]
+            to_i = visit_order[0]
+            decoded = leg_polylines[-1]
+            if decoded:
+                travel_time = time_matrix[from_i][to_i]
+                travel_dist = distance_matrix[from_i][to_i]
+                from_dep = time_lookup.get(from_i, ("", ""))[1]
+                to_arr = time_lookup.get(to_i, ("", ""))[0]
+
+                popup = f"""
+                <div style='width: 320px; font-size: 14px; font-family: Arial; line-height: 1.6'>
+                <b style="font-size: 15px;">{driver_label}Return to Depot</b><br>
+                <b>From:</b> {location_names[from_i]}<br>
+                <span style='font-size:13px'>{address_list[from_i]}</span><br>
+                <b>To:</b> {location_names[to_i]}<br>
+                <span style='font-size:13px'>{address_list[to_i]}</span><br><br>
+                <b>Departure:</b> {from_dep}<br>
+                <b>Arrival:</b> {to_arr}<br>
+                <b>Travel Time:</b> {travel_time:.1f} min<br>
+                <b>Distance:</b> {travel_dist:.1f} km
+                </div>
+                """
+
+                folium.PolyLine(
+                    decoded,
+                    color='black',
+                    weight=7,
+                    opacity=0.9,
+                    popup=popup
+                ).add_to(m)
 
     m.fit_bounds(route_coords, padding=(150, 150))
-    m.save("static/route_map.html")
-    print("✅ Map saved as route_map.html")
+    return m.get_root().render()
 
 
 def extract_route_text(data, manager, routing, solution):
@@ -226,6 +379,8 @@ def extract_route_text(data, manager, routing, solution):
     location_addresses = data["location_addresses"]
     location_durations = data["location_durations"]
     arrival_departure_info = []  # list of (stop index, arrival time string, departure time string)
+    vehicle_arrival_departure_info = [[] for _ in range(data["num_vehicles"])]
+    starts, _ = vehicle_starts_ends(data)
 
     for vehicle_id in range(data["num_vehicles"]):
         if not routing.IsVehicleUsed(solution, vehicle_id):
@@ -233,6 +388,7 @@ def extract_route_text(data, manager, routing, solution):
 
         index = routing.Start(vehicle_id)
         route_text += f"Driver {vehicle_id}:\n\n"
+        vehicle_info_start = len(arrival_departure_info)
 
         # Track departure_time from previous stop
         prev_departure_time = None
@@ -256,7 +412,7 @@ def extract_route_text(data, manager, routing, solution):
             # Add to arrival_departure_info
             arrival_departure_info.append((node, arrival_time_str, departure_time_str))
 
-            if node == data["depot"]:
+            if node == starts[vehicle_id]:
                 if is_first_stop:
                     route_text += (
                         f"Departure from origin, {location_addresses[node]}, at {arr_hours}:{arr_minutes:02d}.\n\n"
@@ -307,17 +463,44 @@ def extract_route_text(data, manager, routing, solution):
                 f"Travel back to origin. You will arrive back at your origin at {arrival_time_str}.\n"
             )
 
+        vehicle_arrival_departure_info[vehicle_id] = arrival_departure_info[vehicle_info_start:]
+
     data["arrival_departure_info"] = arrival_departure_info
+    data["vehicle_arrival_departure_info"] = vehicle_arrival_departure_info
     return route_text
 
+def complete_chat(system, prompt, temperature, on_token=None):
+    """
+    One gpt-4o completion. With `on_token`, the reply is streamed and every text
+    delta is passed to on_token as it arrives; the full reply is returned either way.
+    """
+    incr("api.openai")
+    response = get_openai_client().chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt},
+        ],
+        temperature=temperature,
+        stream=on_token is not None
+    )
+    if on_token is None:
+        return response.choices[0].message.content.strip()
+
+    chunks = []
+    try:
+        for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                on_token(delta)
+    finally:
+        response.close()
+    return "".join(chunks).strip()
+
+
+@traced("gpt_error_explanation")
 def get_error_explanation_from_gpt(data):
-    import openai
-    import os
-    from dotenv import load_dotenv
-
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
     def minutes_to_time(m):
         return f"{m // 60:02d}:{m % 60:02d}"
 
@@ -349,28 +532,15 @@ Only list specific reasons, such as:
 Name the specific stops involved. Keep your explanation to 2–3 sharp, high-precision sentences. Avoid vague or generic advice.
 """
 
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are an expert at explaining why a routing optimization failed."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.3
+    return complete_chat(
+        "You are an expert at explaining why a routing optimization failed.", prompt, temperature=0.3
     )
 
-    return response.choices[0].message.content.strip()
 
 
 
-
-def get_summary_from_gpt(route_text, trip_summary=None):
-    import openai
-    from dotenv import load_dotenv
-    import os
-
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
+@traced("gpt_summary")
+def get_summary_from_gpt(route_text, trip_summary=None, on_token=None):
     # Build base prompt
     prompt = f"""
     Here is an optimized route, structured as a full schedule:
@@ -422,18 +592,10 @@ def get_summary_from_gpt(route_text, trip_summary=None):
         """
 
     # Call GPT
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a friendly assistant helping explain delivery routes."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.7
+    return complete_chat(
+        "You are a friendly assistant helping explain delivery routes.", prompt, temperature=0.7, on_token=on_token
     )
 
-    reply_text = response.choices[0].message.content.strip()
-    return reply_text
-
 
 
 def compute_trip_summary(data, visit_order, arrival_departure_info):
@@ -450,7 +612,7 @@ def compute_trip_summary(data, visit_order, arrival_departure_info):
     for idx in visit_order:
         total_stop_time += data["location_durations"][idx]
 
-    depot = data["depot"]
+    depot = visit_order[0]
     start_time = None
     end_time = None
 
@@ -467,10 +629,6 @@ def compute_trip_summary(data, visit_order, arrival_departure_info):
             end_time = arr
             break
 
-    print("\narrival_departure_info")
-    for entry in arrival_departure_info:
-        print(entry)
-
     return {
         "total_stops": len(visit_order) - 1,
         "total_distance": total_distance,
@@ -483,14 +641,41 @@ def compute_trip_summary(data, visit_order, arrival_departure_info):
         "end_location": data["location_names"][final_node]
     }
 
-def get_explanation_from_gpt(trip_summary, route_text):
-    import openai
-    import os
-    from dotenv import load_dotenv
+def compute_fleet_summary(data, visit_orders, vehicle_arrival_departure_info):
+    """
+    Trip summary for a multi-vehicle solution: per-vehicle summaries under "vehicles",
+    plus fleet totals with the same keys as compute_trip_summary.
+    """
+    vehicles = []
+    for vehicle_id, (visit_order, info) in enumerate(zip(visit_orders, vehicle_arrival_departure_info)):
+        if not visit_order:
+            continue
+        summary = compute_trip_summary(data, visit_order, info)
+        summary["vehicle_id"] = vehicle_id
+        vehicles.append(summary)
+
+    def clock_minutes(clock):
+        hours, minutes = clock.split(":")
+        return int(hours) * 60 + int(minutes)
 
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
+    known_starts = [v["start_time"] for v in vehicles if v["start_time"] != "?"]
+    known_ends = [v["end_time"] for v in vehicles if v["end_time"] != "?"]
+    return {
+        "total_stops": sum(v["total_stops"] for v in vehicles),
+        "total_distance": sum(v["total_distance"] for v in vehicles),
+        "total_travel_time": sum(v["total_travel_time"] for v in vehicles),
+        "total_stop_time": sum(v["total_stop_time"] for v in vehicles),
+        "start_time": min(known_starts, key=clock_minutes) if known_starts else "?",
+        "end_time": max(known_ends, key=clock_minutes) if known_ends else "?",
+        "return_to_start": all(v["return_to_start"] for v in vehicles),
+        "start_location": ", ".join(dict.fromkeys(v["start_location"] for v in vehicles)),
+        "end_location": ", ".join(dict.fromkeys(v["end_location"] for v in vehicles)),
+        "vehicles_used": len(vehicles),
+        "vehicles": vehicles
+    }
 
+@traced("gpt_explanation")
+def get_explanation_from_gpt(trip_summary, route_text, on_token=None):
     prompt = f"""
 You are an assistant helping users understand why a computed driving route is efficient.
 
@@ -509,135 +694,468 @@ Avoid repeating all stops. Just explain the logic behind the chosen order.
 Only include the most relevant reasoning.
     """
 
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant explaining route optimization logic."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.4
+    return complete_chat(
+        "You are a helpful assistant explaining route optimization logic.", prompt, temperature=0.4,
+        on_token=on_token
+    )
+
+
+
+def vehicle_starts_ends(data):
+    """Per-vehicle start and end node lists, defaulting to the depot and custom_end_index."""
+    num_vehicles = data["num_vehicles"]
+    starts = data.get("vehicle_starts", [data["depot"]] * num_vehicles)
+    ends = data.get("vehicle_ends", [data.get("custom_end_index", data["depot"])] * num_vehicles)
+    return list(starts), list(ends)
+
+
+def route_endpoints(data):
+    """Every node a route starts or ends at, which sparse matrix providers fetch all arcs of."""
+    starts, ends = vehicle_starts_ends(data)
+    return sorted(set(starts) | set(ends) | {data["depot"]})
+
+
+def build_search_parameters(num_nodes, profile=None, time_limit=None, solution_limit=None, improvement_limit=None):
+    """
+    Routing search parameters for a named profile (fast / balanced / quality).
+    The metaheuristic and time limit scale with the number of nodes unless `time_limit` (seconds) is given.
+    `solution_limit` caps the number of solutions explored; `improvement_limit` stops the search
+    once the objective has not improved noticeably over that many solutions.
+    """
+    profile = profile or DEFAULT_SEARCH_PROFILE
+    if profile not in SEARCH_PROFILES:
+        raise ValueError(f"Unknown search profile '{profile}', expected one of {', '.join(SEARCH_PROFILES)}")
+    settings = SEARCH_PROFILES[profile]
+
+    metaheuristic = next(
+        name for max_nodes, name in settings["metaheuristics"] if max_nodes is None or num_nodes <= max_nodes
     )
+    if time_limit is None:
+        base, per_node, cap = settings["time_limit"]
+        time_limit = min(cap, base + per_node * num_nodes)
 
-    return response.choices[0].message.content.strip()
+    search_params = pywrapcp.DefaultRoutingSearchParameters()
+    search_params.first_solution_strategy = getattr(
+        routing_enums_pb2.FirstSolutionStrategy, settings["first_solution_strategy"]
+    )
+    search_params.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+    search_params.time_limit.FromMilliseconds(int(time_limit * 1000))
+    if solution_limit is not None:
+        search_params.solution_limit = solution_limit
+    if improvement_limit is not None:
+        search_params.improvement_limit_parameters.improvement_rate_coefficient = IMPROVEMENT_RATE_COEFFICIENT
+        search_params.improvement_limit_parameters.improvement_rate_solutions_distance = improvement_limit
 
+    annotate(search_profile=profile, metaheuristic=metaheuristic, time_limit=time_limit, num_nodes=num_nodes)
+    return search_params
 
 
-def solve_vrptw(data):
+def build_transit_matrix(data):
     """
-    Solves the VRPTW problem and returns the manager, routing model, and solution.
+    Node-indexed int64 matrix of travel time plus the service time at the origin stop
+    (vehicle starts have no service time).
+    """
+    transit = np.asarray(data["time_matrix"], dtype=np.int64)
+    service = np.asarray(data["location_durations"], dtype=np.int64).copy()
+    starts, _ = vehicle_starts_ends(data)
+    service[sorted(set(starts))] = 0
+    return transit + service[:, None]
+
+
+def build_routing_model(data, soft=False):
+    """
+    Builds the routing index manager and model (time dimension, windows, capacities,
+    precedence) for a data dict, without solving it.
     Supports custom end location if 'custom_end_index' is provided in data.
+    With `soft`, stops may be reached up to MAX_LATENESS minutes after their window closes at
+    LATENESS_PENALTY per minute, and may be dropped at a penalty set by their location_priorities entry.
+
+    Fleets are described by optional per-vehicle fields:
+    vehicle_starts / vehicle_ends (node indices), vehicle_shifts ([start, end] in minutes,
+    bounding both departure and return), and vehicle_capacities with location_demands.
+    A vehicle's shift replaces the depot departure and return windows rather than narrowing them,
+    so drivers can work shifts outside the planner's own departure window.
     """
-    failed = False
-    start_index = data["depot"]
-    end_index = data.get("custom_end_index", start_index)
+    num_vehicles = data["num_vehicles"]
+    starts, ends = vehicle_starts_ends(data)
+    start_nodes = set(starts)
 
     # ✅ Use separate start and end lists
     manager = pywrapcp.RoutingIndexManager(
         len(data["time_matrix"]),
-        data["num_vehicles"],
-        [start_index],
-        [end_index]
+        num_vehicles,
+        starts,
+        ends
     )
 
     routing = pywrapcp.RoutingModel(manager)
 
-    # ⏱ Define transit callback (travel time + service time)
-    def time_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        travel_time = data["time_matrix"][from_node][to_node]
-        service_time = data["location_durations"][from_node] if from_node != start_index else 0
-        return travel_time + service_time
-
-    transit_cb = routing.RegisterTransitCallback(time_callback)
+    # ⏱ Transit matrix (travel time + service time), evaluated inside OR-Tools without calling back into Python
+    transit = build_transit_matrix(data)
+    transit_cb = routing.RegisterTransitMatrix(transit.tolist())
     routing.SetArcCostEvaluatorOfAllVehicles(transit_cb)
 
+    # 🚫 Unreachable arcs (no route, or left out of a sparse matrix) are removed from the search outright
+    unreachable = transit >= UNREACHABLE_MINUTES
+    if unreachable.any():
+        index_nodes = [manager.IndexToNode(index) for index in range(routing.Size() + num_vehicles)]
+        for index in range(routing.Size()):
+            blocked = np.flatnonzero(unreachable[index_nodes[index]][index_nodes])
+            if len(blocked):
+                routing.NextVar(index).RemoveValues(blocked.tolist())
+
     # Add Time dimension
     routing.AddDimension(
         transit_cb,
-        10000,  # slack
-        10000,  # max time per vehicle
+        HORIZON,  # slack
+        HORIZON,  # max time per vehicle
         False,  # don't force start cumul to zero
         "Time"
     )
 
     time_dim = routing.GetDimensionOrDie("Time")
 
-    # 🕓 Apply time windows for all nodes (skip inactive ones)
+    def node_index(node):
+        # nodes that only end routes have no node index; use the end of the first vehicle ending there
+        index = manager.NodeToIndex(node)
+        return index if index >= 0 else routing.End(ends.index(node))
+
+    # 🕓 Apply time windows for all stops (vehicle starts and ends are handled below)
+    priorities = data.get("location_priorities")
     for i, window in enumerate(data["time_windows"]):
-        node_index = manager.NodeToIndex(i)
-        time_var = time_dim.CumulVar(node_index)
-        if time_var is not None:
-            time_var.SetRange(window[0], window[1])
+        if i in start_nodes or i in ends:
+            continue
+        index = manager.NodeToIndex(i)
+        if soft:
+            # opening times stay hard (arriving early just means waiting); closing times cost lateness,
+            # up to MAX_LATENESS
+            time_dim.CumulVar(index).SetRange(window[0], min(window[1] + MAX_LATENESS, HORIZON))
+            time_dim.SetCumulVarSoftUpperBound(index, window[1], LATENESS_PENALTY)
+            priority = priorities[i] if priorities else DEFAULT_PRIORITY
+            routing.AddDisjunction([index], PRIORITY_DROP_PENALTIES[priority])
         else:
-            print(f"⚠️ Skipping time window for inactive node {i} ({data['location_names'][i]})")
+            time_dim.CumulVar(index).SetRange(window[0], window[1])
 
-    # Depot departure and return window
-    for v in range(data["num_vehicles"]):
-        time_dim.CumulVar(routing.Start(v)).SetRange(*data["depot_departure_window"])
-        if "custom_end_index" not in data:
-            time_dim.CumulVar(routing.End(v)).SetRange(*data["depot_return_window"])
+    def narrow(var, window):
+        # SetRange only ever narrows the domain, so successive calls intersect; windows that do not
+        # overlap at all are posted as constraints instead, so the solve fails rather than the model build
+        if var.Min() <= window[1] and var.Max() >= window[0]:
+            var.SetRange(*window)
+        else:
+            routing.solver().Add(var >= window[0])
+            routing.solver().Add(var <= window[1])
+
+    # The vehicle's shift, or else the depot departure and return window
+    shifts = data.get("vehicle_shifts")
+    for v in range(num_vehicles):
+        start_var = time_dim.CumulVar(routing.Start(v))
+        end_var = time_dim.CumulVar(routing.End(v))
+        narrow(start_var, data["time_windows"][starts[v]])
+        narrow(start_var, shifts[v] if shifts else data["depot_departure_window"])
+        if shifts:
+            narrow(end_var, shifts[v])
+        elif ends[v] in start_nodes:
+            narrow(end_var, data["depot_return_window"])
+        if ends[v] not in start_nodes:
+            # a custom end keeps its own opening hours, shift or not
+            narrow(end_var, data["time_windows"][ends[v]])
+
+    # Vehicle capacities
+    if "vehicle_capacities" in data:
+        demand_cb = routing.RegisterUnaryTransitVector(list(data["location_demands"]))
+        routing.AddDimensionWithVehicleCapacity(
+            demand_cb,
+            0,  # no slack
+            data["vehicle_capacities"],
+            True,  # start empty
+            "Capacity"
+        )
 
     # Add precedence constraints
     for from_name, to_name in data.get("precedence_constraints", []):
         from_idx = data["location_names"].index(from_name)
         to_idx = data["location_names"].index(to_name)
         routing.solver().Add(
-            time_dim.CumulVar(manager.NodeToIndex(from_idx)) +
+            time_dim.CumulVar(node_index(from_idx)) +
             data["location_durations"][from_idx]
-            <= time_dim.CumulVar(manager.NodeToIndex(to_idx))
+            <= time_dim.CumulVar(node_index(to_idx))
         )
 
     # Optimize route start and end
-    routing.AddVariableMaximizedByFinalizer(time_dim.CumulVar(routing.Start(0)))
-    routing.AddVariableMinimizedByFinalizer(time_dim.CumulVar(routing.End(0)))
+    for v in range(num_vehicles):
+        routing.AddVariableMaximizedByFinalizer(time_dim.CumulVar(routing.Start(v)))
+        routing.AddVariableMinimizedByFinalizer(time_dim.CumulVar(routing.End(v)))
+
+    return manager, routing
+
+
+@traced("solve")
+def solve_vrptw(data, profile=None, time_limit=None, solution_limit=None, improvement_limit=None, initial_routes=None,
+                soft=False):
+    """
+    Solves the VRPTW problem and returns the manager, routing model, and solution.
+    The search follows `profile` (or data["search_profile"]); see build_search_parameters.
+    `initial_routes` (one visit order per vehicle, as returned by extract_visit_orders) warm-starts
+    the search from a previous solution; if it is no longer valid the solve starts cold.
+    `soft` solves with soft windows and droppable stops (see build_routing_model).
+    """
+    failed = False
+    data["solved_soft"] = soft
+    manager, routing = build_routing_model(data, soft=soft)
 
     # Search strategy
-    search_params = pywrapcp.DefaultRoutingSearchParameters()
-    search_params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-    search_params.time_limit.seconds = 10
+    search_params = build_search_parameters(
+        len(data["time_matrix"]),
+        profile or data.get("search_profile"),
+        time_limit=time_limit,
+        solution_limit=solution_limit,
+        improvement_limit=improvement_limit
+    )
 
-    # Solve
-    solution = routing.SolveWithParameters(search_params)
+    # Solve, from the previous routes when given
+    initial_solution = None
+    if initial_routes is not None:
+        routing.CloseModelWithParameters(search_params)
+        starts, ends = vehicle_starts_ends(data)
+        depots = set(starts) | set(ends)
+        routes = [
+            [manager.NodeToIndex(node) for node in route if node not in depots]
+            for route in initial_routes
+        ]
+        initial_solution = routing.ReadAssignmentFromRoutes(routes, True)
+        if initial_solution is None:
+            logger.warning("Previous routes are no longer feasible, solving from scratch")
+
+    if initial_solution is not None:
+        solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_params)
+    else:
+        solution = routing.SolveWithParameters(search_params)
     if solution is None:
         failed = True
 
+    solver = routing.solver()
+    annotate(
+        solver_status=routing.status(),
+        objective=None if failed else solution.ObjectiveValue(),
+        solver_branches=solver.Branches(),
+        solver_solutions=solver.Solutions(),
+        solver_wall_ms=solver.WallTime(),
+        warm_start=initial_solution is not None,
+        soft_constraints=soft
+    )
     return manager, routing, solution, failed
 
 
-def run_vrptw(instruction):
+def solve_plan(data, profile=None, soft_constraints=None, **kwargs):
     """
-    Main function that takes user instruction, solves VRPTW, and returns the route output.
+    solve_vrptw following the SOFT_CONSTRAINTS mode (or `soft_constraints`): "fallback" first
+    tries the hard model and, if it has no solution, returns the best plan that bends windows or
+    drops stops instead. Which constraints were bent, and why the hard model failed, is reported by
+    summarize_solution; data["soft_fallback"] records whether the fallback was taken.
     """
-    gmaps = googlemaps.Client(key=GOOGLEMAPS_API_KEY)
+    mode = soft_constraints or SOFT_CONSTRAINTS
+    if mode not in SOFT_CONSTRAINT_MODES:
+        raise ValueError(f"Unknown soft constraint mode '{mode}', expected one of {', '.join(SOFT_CONSTRAINT_MODES)}")
+    data["soft_fallback"] = False
+    if mode != "always":
+        manager, routing, solution, failed = solve_vrptw(data, profile, **kwargs)
+        if not failed or mode == "off":
+            return manager, routing, solution, failed
+        logger.warning("No route meets every constraint, solving again with soft windows and optional stops")
+        incr("solver.soft_fallback")
+        data["soft_fallback"] = True
+    return solve_vrptw(data, profile, soft=True, **kwargs)
+
+
+def _nearest_hour(hours, minutes):
+    hour = min(max(minutes, 0), 1439) // 60
+    return min(hours, key=lambda h: abs(h - hour))
+
+
+def departure_hours(data, manager, routing, solution, previous):
+    """Hour bucket each node is left in according to a solution; unvisited nodes keep their `previous` hour."""
+    hours = list(data["hourly_time_matrices"])
+    time_dim = routing.GetDimensionOrDie("Time")
+    starts, _ = vehicle_starts_ends(data)
+    node_hours = list(previous)
+    for v in range(routing.vehicles()):
+        index = routing.Start(v)
+        while not routing.IsEnd(index):
+            node = manager.IndexToNode(index)
+            service = 0 if index == routing.Start(v) else data["location_durations"][node]
+            node_hours[node] = _nearest_hour(hours, solution.Min(time_dim.CumulVar(index)) + service)
+            index = solution.Value(routing.NextVar(index))
+    return node_hours
 
-    # Parse, enrich, solve
-    data = parse_instruction(instruction)
-    build_matrices(data, gmaps)
-    manager, routing, solution, failed = solve_vrptw(data)
 
-    if failed:
-        error_explanation = get_error_explanation_from_gpt(data)
-        return None, None, None, None, error_explanation, None, data
+def effective_time_matrix(data, node_hours):
+    """Time matrix whose row i comes from the hourly matrix of the hour node i is left in."""
+    hourly = data["hourly_time_matrices"]
+    return [list(hourly[hour][i]) for i, hour in enumerate(node_hours)]
+
+
+def solve_time_dependent(data, profile=None, max_iterations=None, **kwargs):
+    """
+    Time-dependent solve by iterated re-solving: each round builds the time matrix from the
+    hourly matrices, taking every node's row from the hour it was left in last round, and
+    re-solves warm-started from the previous routes until those hours stop changing.
+    Starts from each stop's earliest possible hour. The final matrix is kept in data["time_matrix"]
+    (so summaries and itineraries use the same travel times as the solver) and the hours in data["node_hours"].
+    """
+    hours = list(data["hourly_time_matrices"])
+    departure = departure_bounds(data)[0]
+    node_hours = data.get("node_hours") or [
+        _nearest_hour(hours, max(window[0], departure)) for window in data["time_windows"]
+    ]
+    initial_routes = kwargs.pop("initial_routes", None)
+
+    for iteration in range(1, (max_iterations or MAX_TIME_DEPENDENT_ITERATIONS) + 1):
+        used_hours = node_hours
+        data["time_matrix"] = effective_time_matrix(data, used_hours)
+        manager, routing, solution, failed = solve_plan(data, profile, initial_routes=initial_routes, **kwargs)
+        if failed:
+            break
+        node_hours = departure_hours(data, manager, routing, solution, used_hours)
+        if node_hours == used_hours:
+            break
+        initial_routes = extract_visit_orders(manager, routing, solution)
     else:
-        error_explanation = None
+        logger.warning("Time-dependent solve did not settle within %s iterations", iteration)
+
+    # the returned solution was solved with used_hours, which is what data["time_matrix"] reflects
+    data["node_hours"] = used_hours
+    annotate(time_dependent_iterations=iteration)
+    return manager, routing, solution, failed
+
+
+def solve_route(data, profile=None, **kwargs):
+    """
+    solve_time_dependent when the data carries hourly matrices, solve_decomposed for large days
+    (see should_decompose) unless previous routes are given to warm-start from, solve_plan otherwise.
+    """
+    if "hourly_time_matrices" in data:
+        return solve_time_dependent(data, profile, **kwargs)
+    if not kwargs.get("initial_routes") and should_decompose(data):
+        return solve_decomposed(data, profile, **kwargs)
+    return solve_plan(data, profile, **kwargs)
+
 
-    # Extract visit order
+def bent_constraints(data, manager, routing, solution):
+    """
+    Stops a soft solve dropped or reaches after closing time:
+    {"dropped": [{index, name}], "late": [{index, name, closes, arrival, minutes_late}]}.
+    """
+    time_dim = routing.GetDimensionOrDie("Time")
+    starts, ends = vehicle_starts_ends(data)
+    endpoints = set(starts) | set(ends)
+    names = data["location_names"]
+    dropped = []
+    late = []
+    for node, (_, close_time) in enumerate(data["time_windows"]):
+        if node in endpoints:
+            continue
+        index = manager.NodeToIndex(node)
+        if solution.Value(routing.NextVar(index)) == index:
+            dropped.append({"index": node, "name": names[node]})
+            continue
+        arrival = solution.Min(time_dim.CumulVar(index))
+        if arrival > close_time:
+            late.append({
+                "index": node,
+                "name": names[node],
+                "closes": minutes_to_clock(close_time),
+                "arrival": minutes_to_clock(arrival),
+                "minutes_late": arrival - close_time,
+            })
+    return {"dropped": dropped, "late": late}
+
+
+def extract_visit_order(manager, routing, solution, vehicle_id=0):
+    """Node indices visited by a vehicle, from its start to its end."""
     visit_order = []
-    index = routing.Start(0)
+    index = routing.Start(vehicle_id)
     while not routing.IsEnd(index):
         visit_order.append(manager.IndexToNode(index))
         index = solution.Value(routing.NextVar(index))
     visit_order.append(manager.IndexToNode(index))
+    return visit_order
 
-    # Route text and summary
+
+def extract_visit_orders(manager, routing, solution):
+    """Visit order of every vehicle, empty for vehicles the solution leaves unused."""
+    return [
+        extract_visit_order(manager, routing, solution, v) if routing.IsVehicleUsed(solution, v) else []
+        for v in range(routing.vehicles())
+    ]
+
+
+@traced("summarize")
+def summarize_solution(data, manager, routing, solution):
+    """
+    Returns (visit_order, route_text, trip_summary) for a solved model.
+    Every vehicle's visit order is stored in data["visit_orders"]; for fleets the
+    trip summary comes from compute_fleet_summary and visit_order is the first used route.
+    After a soft solve, dropped and late stops are stored in data["bent_constraints"] and the trip summary.
+    When the soft solve was a fallback, the local diagnosis of the hard model is stored in data["diagnosis"]
+    and its reasons are added to both, so users see why the plan had to bend.
+    """
+    visit_orders = extract_visit_orders(manager, routing, solution)
+    data["visit_orders"] = visit_orders
     route_text = extract_route_text(data, manager, routing, solution)
-    trip_summary = compute_trip_summary(data, visit_order, data["arrival_departure_info"])
-    summary_text = get_summary_from_gpt(route_text, trip_summary)
-    explanation = get_explanation_from_gpt(trip_summary, route_text)
 
-    # Generate map
-    visualize_route(
+    if data["num_vehicles"] == 1:
+        visit_order = extract_visit_order(manager, routing, solution)
+        trip_summary = compute_trip_summary(data, visit_order, data["arrival_departure_info"])
+    else:
+        visit_order = next((order for order in visit_orders if order), [])
+        trip_summary = compute_fleet_summary(data, visit_orders, data["vehicle_arrival_departure_info"])
+
+    data.pop("bent_constraints", None)
+    if data.get("solved_soft"):
+        data["bent_constraints"] = bent_constraints(data, manager, routing, solution)
+        trip_summary["dropped_stops"] = [stop["name"] for stop in data["bent_constraints"]["dropped"]]
+        trip_summary["late_stops"] = [stop["name"] for stop in data["bent_constraints"]["late"]]
+        if data.get("soft_fallback"):
+            # the soft solution already is the closest route, so relaxation only runs when the
+            # solver-free checks find nothing
+            data["diagnosis"] = diagnose_infeasibility(data, relax_constraints=False)
+            if not data["diagnosis"]["conflicts"]:
+                data["diagnosis"] = diagnose_infeasibility(data)
+            data["bent_constraints"]["reasons"] = data["diagnosis"]["reasons"]
+            trip_summary["unmet_reasons"] = data["diagnosis"]["reasons"]
+
+    return visit_order, route_text, trip_summary
+
+
+@traced("map")
+def render_route_map(data, visit_order, trip_summary):
+    """
+    Draws the solved route(s) with visualize_route; fleets get one colored route per driver.
+    The HTML is kept in map_store under a key derived from the route, its matrices and coordinates,
+    and the key is returned, so identical routes are rendered once and concurrent requests never share
+    a file, while a re-geocoded stop or a new traffic hour re-renders.
+    """
+    vehicle_routes = None
+    if data["num_vehicles"] > 1:
+        vehicle_routes = list(zip(data["visit_orders"], data["vehicle_arrival_departure_info"]))
+
+    map_id = artifact_key(
+        data["location_names"],
+        data["location_addresses"],
+        data["location_durations"],
+        vehicle_routes or [visit_order, data["arrival_departure_info"]],
+        trip_summary["return_to_start"],
+        array_digest(data["time_matrix"]),
+        array_digest(data["distance_matrix"]),
+        data["location_coords"],
+    )
+    # a single get, so an eviction between a membership check and the caller's get cannot lose the map
+    if map_store.get(map_id) is not None:
+        incr("map_store.hits")
+        return map_id
+    incr("map_store.misses")
+
+    html = visualize_route(
         data["location_addresses"],
         visit_order,
         data["location_durations"],
@@ -646,18 +1164,267 @@ def run_vrptw(instruction):
         data["time_matrix"],
         data["arrival_departure_info"],
         return_to_start=trip_summary["return_to_start"],
-        api_key=GOOGLEMAPS_API_KEY
+        api_key=GOOGLEMAPS_API_KEY,
+        coords=data["location_coords"],
+        vehicle_routes=vehicle_routes
+    )
+    return map_store.put(map_id, html)
+
+
+def run_vrptw(instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    """
+    Main function that takes user instruction, solves VRPTW, and returns the route output.
+    `search_profile` picks the solver profile (fast / balanced / quality) and `matrix_provider`
+    the travel matrix source (google / sparse / estimate / osrm) for this request.
+    `itinerary_mode` is "template" (local itinerary text) or "llm" (gpt-4o rewrite).
+    The request's trace (stage spans, API calls, cache hits, solver stats) is stored in data["trace"].
+    """
+    with Trace("run_vrptw") as trace:
+        result = _run_vrptw(instruction, search_profile, matrix_provider, itinerary_mode)
+    result[-1]["trace"] = trace.to_dict()
+    return result
+
+
+def get_itinerary(data, route_text, trip_summary, mode=None, on_token=None):
+    """
+    Itinerary text for a solved route: rendered locally, or rewritten by gpt-4o in "llm" mode
+    (streamed to `on_token` as it is written, when given).
+    """
+    mode = mode or DEFAULT_ITINERARY_MODE
+    if mode not in ITINERARY_MODES:
+        raise ValueError(f"Unknown itinerary mode '{mode}', expected one of {', '.join(ITINERARY_MODES)}")
+    if mode == "llm":
+        return get_summary_from_gpt(route_text, trip_summary, on_token)
+    with span("itinerary"):
+        return render_itinerary(data)
+
+
+@traced("diagnose")
+def explain_failure(data):
+    """
+    Explanation for a failed solve. The local diagnosis (stored in data["diagnosis"]) names the
+    conflicting constraints and the closest relaxed route; DIAGNOSIS_MODE=llm uses gpt-4o instead.
+    """
+    if DIAGNOSIS_MODE == "llm":
+        return get_error_explanation_from_gpt(data)
+    data["diagnosis"] = diagnose_infeasibility(data)
+    return explain_infeasibility(data["diagnosis"])
+
+
+def _run_vrptw(instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    gmaps = get_gmaps_client()
+
+    # Parse, enrich, solve
+    data = parse_instruction(instruction)
+    build_matrices(data, gmaps, matrix_provider)
+    manager, routing, solution, failed = solve_route(data, profile=search_profile)
+
+    if failed:
+        error_explanation = explain_failure(data)
+        return None, None, None, None, error_explanation, None, data
+    else:
+        error_explanation = None
+
+    # Route text and summary
+    visit_order, route_text, trip_summary = summarize_solution(data, manager, routing, solution)
+    summary_text = get_itinerary(data, route_text, trip_summary, itinerary_mode)
+    explanation = get_explanation_from_gpt(trip_summary, route_text)
+
+    # Generate map
+    map_id = render_route_map(data, visit_order, trip_summary)
+
+    return map_id, summary_text, trip_summary, explanation, None, visit_order, data
+
+
+def solve_instruction(instruction, search_profile=None, matrix_provider=None):
+    """
+    Parses and solves an instruction without the GPT narratives or the HTML map.
+    Returns a JSON-serialisable dict: visit order, per-stop arrival/departure times, trip summary and trace.
+    """
+    with Trace("solve_instruction") as trace:
+        result = _solve_instruction(instruction, search_profile, matrix_provider)
+    result["trace"] = trace.to_dict()
+    return result
+
+
+def _solve_instruction(instruction, search_profile=None, matrix_provider=None):
+    gmaps = get_gmaps_client()
+    data = parse_instruction(instruction)
+    build_matrices(data, gmaps, matrix_provider)
+    manager, routing, solution, failed = solve_route(data, profile=search_profile)
+
+    if failed:
+        diagnosis = diagnose_infeasibility(data)
+        return {"status": "infeasible", "error": explain_infeasibility(diagnosis), "diagnosis": diagnosis}
+
+    visit_order, route_text, trip_summary = summarize_solution(data, manager, routing, solution)
+    vehicles = []
+    for vehicle_id, info in enumerate(data["vehicle_arrival_departure_info"]):
+        if not info:
+            continue
+        vehicles.append({
+            "vehicle_id": vehicle_id,
+            "visit_order": data["visit_orders"][vehicle_id],
+            "stops": [
+                {
+                    "index": node,
+                    "name": data["location_names"][node],
+                    "address": data["location_addresses"][node],
+                    "arrival": arrival,
+                    "departure": departure,
+                }
+                for node, arrival, departure in info
+            ],
+        })
+
+    return {
+        "status": "ok",
+        "visit_order": visit_order,
+        "vehicles": vehicles,
+        "trip_summary": trip_summary,
+        "route_text": route_text,
+        "bent_constraints": data.get("bent_constraints"),
+    }
+
+
+async def run_vrptw_async(instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    """
+    Async variant of run_vrptw with the same arguments and return value.
+    Matrix fetching overlaps geocoding, and the itinerary, GPT explanation and map
+    rendering run concurrently once the route is solved, so wall time follows the
+    slowest branch rather than the sum of all stages.
+    """
+    with Trace("run_vrptw_async") as trace:
+        result = await _run_vrptw_async(instruction, search_profile, matrix_provider, itinerary_mode)
+    result[-1]["trace"] = trace.to_dict()
+    return result
+
+
+async def _run_vrptw_async(instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    gmaps = get_gmaps_client()
+
+    data = await asyncio.to_thread(parse_instruction, instruction)
+    addresses = data["location_addresses"]
+    provider = get_matrix_provider(matrix_provider or data.get("matrix_provider"), gmaps)
+    if provider.needs_coords:
+        # offline providers work from coordinates, so geocoding comes first
+        data["location_coords"] = await asyncio.to_thread(geocode_addresses, addresses, gmaps)
+        data["time_matrix"], data["distance_matrix"] = await asyncio.to_thread(
+            timed, "matrices", provider.get_matrices, addresses, data["location_coords"], hubs=route_endpoints(data)
+        )
+    else:
+        (data["time_matrix"], data["distance_matrix"]), data["location_coords"] = await asyncio.gather(
+            asyncio.to_thread(timed, "matrices", provider.get_matrices, addresses),
+            asyncio.to_thread(geocode_addresses, addresses, gmaps),
+        )
+    if data.get("time_dependent", TIME_DEPENDENT):
+        await asyncio.to_thread(build_time_dependent_matrices, data, provider)
+    manager, routing, solution, failed = await asyncio.to_thread(solve_route, data, search_profile)
+
+    if failed:
+        error_explanation = await asyncio.to_thread(explain_failure, data)
+        return None, None, None, None, error_explanation, None, data
+
+    visit_order, route_text, trip_summary = summarize_solution(data, manager, routing, solution)
+
+    summary_text, explanation, map_id = await asyncio.gather(
+        asyncio.to_thread(get_itinerary, data, route_text, trip_summary, itinerary_mode),
+        asyncio.to_thread(get_explanation_from_gpt, trip_summary, route_text),
+        asyncio.to_thread(render_route_map, data, visit_order, trip_summary),
     )
 
-    return "route_map.html", summary_text, trip_summary, explanation, None, visit_order, data
+    return map_id, summary_text, trip_summary, explanation, None, visit_order, data
+
+
+def run_vrptw_stream(instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    """
+    Staged variant of run_vrptw: a generator of (event, payload) pairs, so a UI can show
+    each part of the result as soon as it exists instead of waiting for the slowest one.
+
+        ("solved", {"visit_order", "trip_summary", "route_text", "data"})  as soon as the route is solved
+        ("itinerary_token", text), ("explanation_token", text)  gpt-4o text as it is written
+        ("itinerary", text), ("explanation", text), ("map", map_id)  each part once finished
+        ("failed", error_explanation)  instead of all of the above when no route exists
+        ("done", trace)  last
+
+    The itinerary, explanation and map are produced concurrently once the route is solved.
+    """
+    trace = Trace("run_vrptw_stream")
+    # the trace lives in a private context, so it stays current however the caller interleaves the generator
+    context = contextvars.copy_context()
+    context.run(trace.__enter__)
+    try:
+        data = yield from _run_vrptw_stream(context, instruction, search_profile, matrix_provider, itinerary_mode)
+    finally:
+        context.run(trace.__exit__, None, None, None)
+    data["trace"] = trace.to_dict()
+    yield "done", data["trace"]
+
+
+class StreamClosed(Exception):
+    """Raised from a token callback once the stream's consumer has gone away."""
+
+
+def _run_vrptw_stream(context, instruction, search_profile=None, matrix_provider=None, itinerary_mode=None):
+    data = context.run(parse_instruction, instruction)
+    context.run(build_matrices, data, get_gmaps_client(), matrix_provider)
+    manager, routing, solution, failed = context.run(solve_route, data, search_profile)
 
+    if failed:
+        yield "failed", context.run(explain_failure, data)
+        return data
+
+    visit_order, route_text, trip_summary = context.run(summarize_solution, data, manager, routing, solution)
+    yield "solved", {"visit_order": visit_order, "trip_summary": trip_summary, "route_text": route_text, "data": data}
+
+    events = queue.Queue()
+    # set once the consumer is gone, so streaming stages stop instead of finishing for nobody
+    closed = threading.Event()
+
+    def run_stage(name, func, *args):
+        try:
+            events.put((name, func(*args)))
+        except Exception as e:
+            events.put(("error", e))
+
+    def on_token(event):
+        def put(token):
+            if closed.is_set():
+                raise StreamClosed()
+            events.put((event, token))
+        return put
+
+    stages = [
+        ("itinerary", get_itinerary, data, route_text, trip_summary, itinerary_mode, on_token("itinerary_token")),
+        ("explanation", get_explanation_from_gpt, trip_summary, route_text, on_token("explanation_token")),
+        ("map", render_route_map, data, visit_order, trip_summary),
+    ]
+    # not a with-block: its exit would wait for every stage when the client disconnects or a stage fails
+    pool = ThreadPoolExecutor(max_workers=len(stages))
+    try:
+        for stage in stages:
+            pool.submit(context.copy().run, run_stage, *stage)
+        remaining = len(stages)
+        while remaining:
+            event, payload = events.get()
+            if event == "error":
+                raise payload
+            if not event.endswith("_token"):
+                remaining -= 1
+            yield event, payload
+    finally:
+        closed.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return data
 
 
 def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
     scenario_name = "Vague"
     instruction = load_user_instruction("user_instruction_scenarios.txt", scenario_name)
 
-    map_file, summary, trip_summary, explanation, error_explanation, visit_order, data = run_vrptw(instruction)
+    map_id, summary, trip_summary, explanation, error_explanation, visit_order, data = run_vrptw(instruction)
 
     if error_explanation:
         print("❌ GPT Error Explanation:")
@@ -673,6 +1440,17 @@ def main():
         print("\n=== GPT Explanation ===")
         print(explanation)
 
+        print("\n=== Stage Timings ===")
+        for stage in data["trace"]["spans"]:
+            print(f"{stage['name']}: {stage['duration']:.2f}s")
+
+        html = map_store.get(map_id)
+        if html is None:
+            # evicted from the store since it was rendered
+            html = map_store.get(render_route_map(data, visit_order, trip_summary))
+        map_file = "route_map.html"
+        with open(map_file, "w", encoding="utf-8") as f:
+            f.write(html)
         print(f"\n✅ Map saved to {map_file}")
 
 